@@ -0,0 +1,285 @@
+"""
+Offline benchmarks of srtm4, on synthetic tiles.
+
+Synthetic 6000x6000 int16 srtm_XX_YY.tif tiles, laid out as the SRTM ones
+(uncompressed, striped, georeferenced GeoTIFF), are written to a temporary
+SRTM4_CACHE, so that nothing is downloaded. Each benchmark reports its best
+time over a few runs, as points/s or pixels/s, MB/s and the peak resident
+memory of the process during the benchmark.
+
+Usage, from the root of the repository, after make for the native and
+subprocess engines:
+    python benchmarks/bench_srtm4.py [--points N] [--engine ENGINE]
+                                     [--repeat N] [--json results.json]
+
+The srtm4 package of the repository is benchmarked, even if srtm4 is not
+installed or another version of it is.
+
+The crop, merge, write_crop_to_file and crop_to_file benchmarks need the crop
+extras (rasterio, pyproj, affine) and are skipped without them.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# import the srtm4 package of this repository before any installed one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TILE_SIZE = 6000
+RES = 5 / TILE_SIZE
+
+# 2x2 tiles around (5E, 45N): srtm_37_03, srtm_38_03, srtm_37_04, srtm_38_04
+TILES = [(37, 3), (38, 3), (37, 4), (38, 4)]
+LON_MIN, LON_MAX, LAT_MIN, LAT_MAX = 0, 10, 40, 50
+
+# 1x1 degree crop on the corner of the four tiles
+CROP_BOUNDS = (4.5, 44.5, 5.5, 45.5)
+
+
+def synthetic_tile(lon_id, lat_id):
+    """
+    Smooth int16 relief with a sea area of -32768 in a corner, different for
+    each tile.
+    """
+    x = np.arange(TILE_SIZE) * (2 * np.pi / TILE_SIZE)
+    rows = 400 * np.sin(3 * x + lat_id) + 50 * np.sin(97 * x)
+    cols = 600 * np.cos(2 * x + lon_id) + 50 * np.cos(89 * x)
+    data = (1000 + rows[:, None] + cols[None, :]).astype(np.int16)
+    data[:TILE_SIZE // 10, :TILE_SIZE // 10] = -32768
+    return data
+
+
+def write_geotiff(path, data, lon0, lat0, rows_per_strip=16):
+    """
+    Write an int16 array as an uncompressed, striped, little-endian GeoTIFF
+    in geographic coordinates, with (lon0, lat0) the corner of its first
+    pixel.
+    """
+    height, width = data.shape
+    n_strips = -(-height // rows_per_strip)
+    strip_bytes = [2 * width * min(rows_per_strip, height - i * rows_per_strip)
+                   for i in range(n_strips)]
+    strip_offsets = list(8 + np.cumsum([0] + strip_bytes[:-1]))
+    ifd_offset = 8 + 2 * data.size
+
+    # (tag, type, values): type 2 ASCII, 3 SHORT, 4 LONG, 12 DOUBLE
+    entries = [(256, 4, [width]),
+               (257, 4, [height]),
+               (258, 3, [16]),
+               (259, 3, [1]),  # no compression
+               (262, 3, [1]),  # min is black
+               (273, 4, strip_offsets),
+               (277, 3, [1]),
+               (278, 4, [rows_per_strip]),
+               (279, 4, strip_bytes),
+               (284, 3, [1]),  # contiguous
+               (339, 3, [2]),  # signed integers
+               (33550, 12, [RES, RES, 0]),  # ModelPixelScale
+               (33922, 12, [0, 0, 0, lon0, lat0, 0]),  # ModelTiepoint
+               (34735, 3, [1, 1, 0, 3,  # GeoKeyDirectory
+                           1024, 0, 1, 2,  # geographic
+                           1025, 0, 1, 1,  # pixel is area
+                           2048, 0, 1, 4326]),  # WGS84
+               (42113, 2, b'-32768\0')]  # GDAL nodata
+    formats = {2: 's', 3: 'H', 4: 'I', 12: 'd'}
+
+    ifd = struct.pack('<H', len(entries))
+    extra = b''
+    extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    for tag, typ, values in entries:
+        n = len(values)
+        if typ == 2:
+            value = struct.pack('<{}s'.format(n), values)
+        else:
+            value = struct.pack('<{}{}'.format(n, formats[typ]), *values)
+        if len(value) <= 4:
+            ifd += struct.pack('<HHI', tag, typ, n) + value.ljust(4, b'\0')
+        else:
+            ifd += struct.pack('<HHII', tag, typ, n,
+                               extra_offset + len(extra))
+            extra += value + b'\0' * (len(value) % 2)
+    ifd += struct.pack('<I', 0)
+
+    with open(path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        f.write(data.astype('<i2').tobytes())
+        f.write(ifd)
+        f.write(extra)
+
+
+def write_tiles(cache_dir):
+    """Write the synthetic tiles to a cache directory."""
+    for lon_id, lat_id in TILES:
+        path = os.path.join(cache_dir, 'srtm_{:02d}_{:02d}.tif'.format(lon_id,
+                                                                      lat_id))
+        write_geotiff(path, synthetic_tile(lon_id, lat_id),
+                      -180 + 5 * (lon_id - 1), 60 - 5 * (lat_id - 1))
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of the process, on Linux."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Peak resident memory of the process in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def bench(name, func, items, nbytes, unit='points', repeat=3):
+    """
+    Time func, and report its throughput in items and bytes per second.
+
+    Returns:
+        dict of the results
+    """
+    _reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    result = {'name': name, 'seconds': best,
+              '{}_per_s'.format(unit): items / best,
+              'mb_per_s': nbytes / best / 1e6,
+              'peak_rss_mb': _peak_rss()}
+    print('{:<32} {:>10.4f} s {:>14.0f} {}/s {:>10.1f} MB/s {:>8.0f} MB RSS'.format(
+        name, best, items / best, unit, nbytes / best / 1e6,
+        result['peak_rss_mb']))
+    return result
+
+
+def run(n_points, engine=None, repeat=3):
+    """
+    Run the benchmarks on the tiles of SRTM4_CACHE.
+
+    Returns:
+        list of dicts of the results
+    """
+    import srtm4
+
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(LON_MIN, LON_MAX, n_points)
+    lats = rng.uniform(LAT_MIN, LAT_MAX, n_points)
+    n_list = min(n_points, 100000)
+    n_scalar = min(n_points, 1000)
+    lon_list, lat_list = list(lons[:n_list]), list(lats[:n_list])
+
+    # coordinates in, heights out
+    point_bytes = 3 * 8
+
+    # load the tiles once, so that all the benchmarks run on a warm cache
+    srtm4.srtm4(lons[:1000], lats[:1000], engine=engine)
+
+    def scalar():
+        for lon, lat in zip(lon_list[:n_scalar], lat_list[:n_scalar]):
+            srtm4.srtm4(lon, lat, engine=engine)
+
+    results = [
+        bench('srtm4 scalar', scalar, n_scalar, n_scalar * point_bytes,
+              repeat=repeat),
+        bench('srtm4 list', lambda: srtm4.srtm4(lon_list, lat_list,
+                                                engine=engine),
+              n_list, n_list * point_bytes, repeat=repeat),
+        bench('srtm4 ndarray', lambda: srtm4.srtm4(lons, lats, engine=engine),
+              n_points, n_points * point_bytes, repeat=repeat),
+        bench('srtm4 ndarray orthometric',
+              lambda: srtm4.srtm4(lons, lats, datum='orthometric',
+                                  engine=engine),
+              n_points, n_points * point_bytes, repeat=repeat),
+        bench('srtm4_which_tile', lambda: srtm4.srtm4_which_tile(lon_list,
+                                                                 lat_list),
+              n_list, n_list * 2 * 8, repeat=repeat),
+    ]
+
+    try:
+        from srtm4 import raster
+    except ImportError as e:
+        print('skipping the crop benchmarks: {}'.format(e))
+        return results
+
+    for datum in ('orthometric', 'ellipsoidal'):
+        array, _, _ = srtm4.crop(CROP_BOUNDS, datum=datum)
+        results.append(bench('crop {}'.format(datum),
+                             lambda: srtm4.crop(CROP_BOUNDS, datum=datum),
+                             array.size, array.nbytes, 'pixels', repeat))
+
+    bounds, transform, shape, paths = raster._crop_grid(CROP_BOUNDS)
+    results.append(bench('merge',
+                         lambda: raster.merge(paths, transform, shape),
+                         shape[0] * shape[1], 4 * shape[0] * shape[1],
+                         'pixels', repeat))
+
+    array, transform, crs = srtm4.crop(CROP_BOUNDS)
+    out_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(out_dir, 'crop.tif')
+        results.append(bench('write_crop_to_file',
+                             lambda: srtm4.write_crop_to_file(
+                                 array, transform, crs, path),
+                             array.size, array.nbytes, 'pixels', repeat))
+        results.append(bench('crop_to_file',
+                             lambda: srtm4.crop_to_file(CROP_BOUNDS, path),
+                             array.size, array.nbytes, 'pixels', repeat))
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--points', type=int, default=4000000,
+                        help='number of points of the ndarray queries')
+    parser.add_argument('--engine', choices=('server', 'native', 'subprocess',
+                                             'numpy'),
+                        help='engine of the point queries')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='srtm4-bench-')
+    try:
+        # srtm4 reads SRTM4_CACHE when it is imported
+        os.environ['SRTM4_CACHE'] = cache_dir
+        start = time.perf_counter()
+        write_tiles(cache_dir)
+        print('wrote {} synthetic tiles in {:.1f} s'.format(
+            len(TILES), time.perf_counter() - start))
+        results = run(args.points, args.engine, args.repeat)
+    finally:
+        shutil.rmtree(cache_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'engine': args.engine,
+                       'points': args.points,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
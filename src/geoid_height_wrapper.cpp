@@ -1,9 +1,65 @@
+#include <atomic>
+#include <mutex>
 #include <string>
 #include <exception>
 #include "Geoid.hpp"
 
+// directory of the geoid data, empty means GEOID_PATH or the default path
+static std::string geoid_path;
+
+// the geoid is read once, fully in memory (threadsafe implies CacheAll), by
+// the first thread using it, and then evaluated by all the threads at once
+static std::atomic<GeographicLib::Geoid *> egm96(NULL);
+static std::mutex egm96_lock;
+
+// number of geoid heights evaluated, for the stats of the python module
+static std::atomic<unsigned long long> evaluations(0);
+
+static const GeographicLib::Geoid &get_geoid(void)
+{
+    GeographicLib::Geoid *g = egm96.load(std::memory_order_acquire);
+    if (!g) {
+        std::lock_guard<std::mutex> lock(egm96_lock);
+        g = egm96.load(std::memory_order_relaxed);
+        if (!g) {
+            g = new GeographicLib::Geoid("egm96-15", geoid_path, true, true);
+            egm96.store(g, std::memory_order_release);
+        }
+    }
+    return *g;
+}
+
+// the geoid must not be in use by other threads when its path changes
+extern "C" void geoid_set_path(const char *path)
+{
+    std::string p = path ? path : "";
+    std::lock_guard<std::mutex> lock(egm96_lock);
+    if (p != geoid_path) {
+        delete egm96.exchange(NULL);
+        geoid_path = p;
+    }
+}
+
 extern "C" void geoid_height(double *out, double lat, double lon)
 {
-    GeographicLib::Geoid egm96("egm96-15");
-    *out = egm96(lat, lon);
+    *out = get_geoid()(lat, lon);
+    evaluations.fetch_add(1, std::memory_order_relaxed);
+}
+
+// evaluate the geoid height of n points
+extern "C" void geoid_heights(double *out, const double *lat,
+        const double *lon, long n)
+{
+    const GeographicLib::Geoid &g = get_geoid();
+    for (long i = 0; i < n; i++)
+        out[i] = g(lat[i], lon[i]);
+    evaluations.fetch_add(n, std::memory_order_relaxed);
+}
+
+// read the number of geoid heights evaluated, and reset it if requested
+extern "C" unsigned long long geoid_evaluations(int reset)
+{
+    if (reset)
+        return evaluations.exchange(0, std::memory_order_relaxed);
+    return evaluations.load(std::memory_order_relaxed);
 }
@@ -9,39 +9,111 @@
 #include <tiffio.h>
 
 #include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <unistd.h>
+#include <sys/mman.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 
 #define NO_DATA NAN
-#define SRTM4_ASC "%s/srtm_%02d_%02d.asc"
+#define TILE_SIZE 6000
 #define SRTM4_TIF "%s/srtm_%02d_%02d.tif"
+#define SRTM4_NPY "%s/srtm_%02d_%02d.npy"
+#define NPY_HEADER_SIZE 128
+
+// int16 samples of a tile, either decoded in memory or mapped from its sidecar
+struct tile {
+    int16_t *data;
+    void *map;       // mmap of the sidecar, or NULL
+    size_t map_size;
+    unsigned long long last_use; // for the LRU eviction
+
+    // the tif file is decoded lazily, by blocks of block_rows rows. It stays
+    // open until all the rows are there, so that its layout cannot change
+    // if it is replaced meanwhile. loaded flags the decoded blocks, it is
+    // NULL once all the rows are there and complete is set
+    char *path;
+    TIFF *tif;
+    bool *loaded;
+    int block_rows, nblocks, nloaded;
+    bool complete;   // read without lock by the threads pinning the tile
+
+    int refs;        // number of pins, a pinned tile is never evicted
+};
+
+// minimal number of rows decoded at once
+#define BLOCK_ROWS 64
+
+// counters of the tile cache
+struct srtm4_tile_cache_stats {
+    unsigned long long hits, misses, evictions;
+    unsigned long long tiles, bytes, max_bytes; // max_bytes 0 means no limit
+    unsigned long long blocks; // blocks of rows decoded by the lazy loading
+};
 
 // headers
 void geoid_height(double *out, double lat, double lon);
+void geoid_heights(double *out, const double *lat, const double *lon, long n);
+
+
+// decode the rows [j0, j1) of a TIFF int16 image of width w into data. For a
+// striped image, j0 is the first row of a strip
+static bool read_tiff_rows(TIFF *tif, int16_t *data, uint32 w,
+        uint32 j0, uint32 j1)
+{
+    if (TIFFIsTiled(tif)) {
+        uint32 tw = 0, th = 0;
+        TIFFGetField(tif, TIFFTAG_TILEWIDTH, &tw);
+        TIFFGetField(tif, TIFFTAG_TILELENGTH, &th);
+        assert((size_t) TIFFTileSize(tif) == tw * th * sizeof(int16_t));
+        int16_t *block = (int16_t *) malloc(TIFFTileSize(tif));
+        for (uint32 y = j0 - j0 % th; y < j1; y += th)
+        for (uint32 x = 0; x < w; x += tw) {
+            if (TIFFReadTile(tif, block, x, y, 0, 0) < 0) {
+                fprintf(stderr, "readTIFF: error reading tile %u %u\n", x, y);
+                free(block);
+                return false;
+            }
+            // the tiles on the right and bottom borders are padded, and only
+            // the rows of the tiles in [j0, j1) are copied
+            uint32 cw = w - x < tw ? w - x : tw;
+            uint32 ja = y < j0 ? j0 - y : 0;
+            uint32 jb = j1 - y < th ? j1 - y : th;
+            for (uint32 j = ja; j < jb; j++)
+                memcpy(data + (y + j) * w + x, block + j * tw,
+                        cw * sizeof(int16_t));
+        }
+        free(block);
+        return true;
+    }
 
+    assert((size_t) TIFFScanlineSize(tif) == w * sizeof(int16_t));
+    for (uint32 i = j0; i < j1; i++) {
+        if (TIFFReadScanline(tif, data + i * w, i, 0) < 0) {
+            fprintf(stderr, "readTIFF: error reading row %u\n", i);
+            return false;
+        }
+    }
+    return true;
+}
 
-// read a TIFF int16 image
+// read a TIFF int16 image, striped or internally tiled
 static int16_t *readTIFF(TIFF *tif, int *nx, int *ny)
 {
     uint32 w = 0, h = 0;
-    int16_t *data, *line;
+    int16_t *data;
 
     TIFFGetField(tif, TIFFTAG_IMAGEWIDTH, &w);
     TIFFGetField(tif, TIFFTAG_IMAGELENGTH, &h);
-    assert((size_t) TIFFScanlineSize(tif) == w * sizeof(int16_t));
 
     data = (int16_t *) malloc(w*h*sizeof(int16_t));
     *nx = (int) w;
     *ny = (int) h;
-    for (int i = 0; i < h; i++) {
-        line = data + i * w;
-        if (TIFFReadScanline(tif, line, i, 0) < 0) {
-            fprintf(stderr, "readTIFF: error reading row %u\n", i);
-            free(data);
-            return NULL;
-        }
+    if (!read_tiff_rows(tif, data, w, 0, h)) {
+        free(data);
+        return NULL;
     }
-
     return data;
 }
 
@@ -60,12 +132,32 @@ int16_t *read_tiff_int16_gray(const char *fname, int *nx, int *ny)
     return data;
 }
 
-// return the name of the cache directory
-static char *cachedir(void)
+// cache directory set by the library caller, overrides SRTM4_CACHE
+static char forced_cachedir[FILENAME_MAX] = "";
+
+// the table of tiles, the counters of the cache and the cache directory are
+// shared by the threads, and only accessed with this lock held
+static pthread_mutex_t tiles_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static void free_tiles(void);
+
+// the loaded tiles are dropped when the cache directory changes
+void srtm4_set_cachedir(const char *path)
+{
+    if (!path)
+        path = "";
+    pthread_mutex_lock(&tiles_lock);
+    if (strcmp(path, forced_cachedir)) {
+        free_tiles();
+        snprintf(forced_cachedir, FILENAME_MAX, "%s", path);
+    }
+    pthread_mutex_unlock(&tiles_lock);
+}
+
+// write the name of the cache directory into output_dirname, and return it
+static char *cachedir(char output_dirname[FILENAME_MAX])
 {
-    // XXX TODO FIXME WRONG WARNING : THIS code is not reentrant
-    static char output_dirname[FILENAME_MAX];
-    char *env_cache = getenv("SRTM4_CACHE");
+    char *env_cache = *forced_cachedir ? forced_cachedir : getenv("SRTM4_CACHE");
     if (env_cache) {
         snprintf(output_dirname, FILENAME_MAX, "%s", env_cache);
     } else {
@@ -127,170 +219,381 @@ static bool file_exists(const char *fname)
     return false;
 }
 
-static char *get_tile_filename(int tlon, int tlat, bool tif)
+static char *get_tile_filename(char fname[FILENAME_MAX], int tlon, int tlat,
+        const char *pattern)
 {
-    // XXX TODO FIXME WRONG WARNING : THIS code is not reentrant
-    static char fname[FILENAME_MAX];
-    // use TIF or ASC filename pattern according to boolean param 'tif'
-    if (tif)
-        snprintf(fname, FILENAME_MAX, SRTM4_TIF, cachedir(), tlon, tlat);
-    else
-        snprintf(fname, FILENAME_MAX, SRTM4_ASC, cachedir(), tlon, tlat);
+    char dirname[FILENAME_MAX];
+    snprintf(fname, FILENAME_MAX, pattern, cachedir(dirname), tlon, tlat);
     return fname;
 }
 
-static char *malloc_file_contents(char *filename, int *size)
+// the sidecar of a tile is a .npy file holding its raw int16 samples
+// in native byte order, which can be mapped in memory by C and numpy
+static bool little_endian(void)
 {
-    FILE *f = fopen(filename, "r");
+    uint16_t x = 1;
+    return *(uint8_t *) &x;
+}
+
+static void npy_header(char header[NPY_HEADER_SIZE])
+{
+    int n = snprintf(header, NPY_HEADER_SIZE, "\x93NUMPY\x01%c%c%c"
+            "{'descr': '%ci2', 'fortran_order': False, "
+            "'shape': (%d, %d), }", 0, NPY_HEADER_SIZE - 10, 0,
+            little_endian() ? '<' : '>', TILE_SIZE, TILE_SIZE);
+    memset(header + n, ' ', NPY_HEADER_SIZE - n);
+    header[NPY_HEADER_SIZE - 1] = '\n';
+}
+
+// write the sidecar of a tile, atomically, return true on success
+static bool write_sidecar(const char *fname, const int16_t *data)
+{
+    char tmp[FILENAME_MAX + 32], header[NPY_HEADER_SIZE];
+    snprintf(tmp, sizeof tmp, "%s.%d.tmp", fname, (int) getpid());
+    FILE *f = fopen(tmp, "wb");
     if (!f)
+        return false;
+    npy_header(header);
+    size_t n = (size_t) TILE_SIZE * TILE_SIZE;
+    bool ok = 1 == fwrite(header, NPY_HEADER_SIZE, 1, f)
+           && n == fwrite(data, sizeof*data, n, f);
+    ok = (0 == fclose(f)) && ok;
+    if (ok)
+        ok = 0 == rename(tmp, fname);
+    if (!ok)
+        remove(tmp);
+    return ok;
+}
+
+// map the sidecar of a tile in memory, return NULL if it is not usable
+static int16_t *map_sidecar(const char *fname, struct tile *t)
+{
+    int fd = open(fname, O_RDONLY);
+    if (fd < 0)
         return NULL;
-    fseek(f, 0, SEEK_END);
-    int n = ftell(f);
-    fseek(f, 0, SEEK_SET);
-    char *r = malloc(n+1);
-    if (!r)
+    size_t size = NPY_HEADER_SIZE + sizeof(int16_t) * TILE_SIZE * TILE_SIZE;
+    char header[NPY_HEADER_SIZE], expected[NPY_HEADER_SIZE];
+    struct stat st;
+    npy_header(expected);
+    if (fstat(fd, &st) || (size_t) st.st_size != size
+            || NPY_HEADER_SIZE != read(fd, header, NPY_HEADER_SIZE)
+            || memcmp(header, expected, NPY_HEADER_SIZE)) {
+        fprintf(stderr, "WARNING: ignoring invalid tile sidecar %s\n", fname);
+        close(fd);
         return NULL;
-    int rr = fread(r, 1, n, f);
-    if (rr != n)
+    }
+    void *map = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED)
         return NULL;
-    fclose(f);
-    r[n] = '\0';
-    *size = n+1;
-    return r;
+    t->map = map;
+    t->map_size = size;
+    return (int16_t *) ((char *) map + NPY_HEADER_SIZE);
+}
+
+// sidecars are written unless SRTM4_SIDECAR=0
+static bool sidecars_enabled(void)
+{
+    char *env = getenv("SRTM4_SIDECAR");
+    return !env || strcmp(env, "0");
 }
 
-static int my_atoi(char *s)
+// tiles (tlon, tlat), for tlon in 1..72 and tlat in 1..24
+static struct tile global_table_of_tiles[73][25];
+
+// the rows of a tile are decoded with its lock held, by one thread at a time
+static pthread_mutex_t tile_locks[73][25];
+static pthread_once_t tile_locks_once = PTHREAD_ONCE_INIT;
+
+static void init_tile_locks(void)
 {
-    int r = 0, sign = 1;
-    if (*s == '-') {
-        sign = -1;
-        s += 1;
+    for (int j = 0; j < 73; j++)
+    for (int i = 0; i < 25; i++)
+        pthread_mutex_init(&tile_locks[j][i], NULL);
+}
+
+// the loaded tiles are evicted, least recently used first, to keep their
+// total size below SRTM4_MAX_TILE_BYTES (unset or 0 means no limit)
+#define TILE_BYTES (sizeof(int16_t) * TILE_SIZE * TILE_SIZE)
+static struct srtm4_tile_cache_stats cache_stats;
+static unsigned long long cache_clock;
+static bool max_bytes_initialized;
+
+static void set_max_tile_bytes(unsigned long long max_bytes)
+{
+    cache_stats.max_bytes = max_bytes;
+    max_bytes_initialized = true;
+}
+
+void srtm4_set_max_tile_bytes(unsigned long long max_bytes)
+{
+    pthread_mutex_lock(&tiles_lock);
+    set_max_tile_bytes(max_bytes);
+    pthread_mutex_unlock(&tiles_lock);
+}
+
+static unsigned long long max_tile_bytes(void)
+{
+    if (!max_bytes_initialized) {
+        char *env = getenv("SRTM4_MAX_TILE_BYTES");
+        set_max_tile_bytes(env ? strtoull(env, NULL, 10) : 0);
     }
-    while (*s)
-    {
-        r *= 10;
-        r += *s - '0';
-        s += 1;
+    return cache_stats.max_bytes;
+}
+
+static void unload_tile(struct tile *t)
+{
+    if (t->map)
+        munmap(t->map, t->map_size);
+    else
+        free(t->data);
+    if (t->tif)
+        TIFFClose(t->tif);
+    free(t->path);
+    free(t->loaded);
+    memset(t, 0, sizeof*t);
+    cache_stats.tiles -= 1;
+    cache_stats.bytes -= TILE_BYTES;
+}
+
+// evict tiles until room bytes more fit in the cache, except the tile loaded
+// if any. The pinned tiles are kept, even if the cache goes over its size:
+// they are evicted when they are released
+static void evict_tiles(const struct tile *loaded, unsigned long long room)
+{
+    unsigned long long max_bytes = max_tile_bytes();
+    while (max_bytes && cache_stats.tiles
+            && cache_stats.bytes + room > max_bytes) {
+        struct tile *lru = NULL;
+        for (int j = 1; j <= 72; j++)
+        for (int i = 1; i <= 24; i++) {
+            struct tile *t = &global_table_of_tiles[j][i];
+            if (t->data && !t->refs && t != loaded
+                    && (!lru || t->last_use < lru->last_use))
+                lru = t;
+        }
+        if (!lru)
+            break;
+        unload_tile(lru);
+        cache_stats.evictions += 1;
     }
-    return sign * r;
 }
 
-static const int spacing[0x100] = {
-    [' '] = 1, ['\t'] = 1, ['\f'] = 1, ['\n'] = 1, ['\r'] = 1
-};
+void srtm4_tile_cache_stats(struct srtm4_tile_cache_stats *out)
+{
+    pthread_mutex_lock(&tiles_lock);
+    max_tile_bytes();
+    *out = cache_stats;
+    out->blocks = __atomic_load_n(&cache_stats.blocks, __ATOMIC_RELAXED);
+    pthread_mutex_unlock(&tiles_lock);
+}
 
-static int my_isspace(unsigned char c)
+void srtm4_reset_tile_cache_stats(void)
 {
-    return spacing[c];
+    pthread_mutex_lock(&tiles_lock);
+    cache_stats.hits = cache_stats.misses = cache_stats.evictions = 0;
+    __atomic_store_n(&cache_stats.blocks, 0, __ATOMIC_RELAXED);
+    pthread_mutex_unlock(&tiles_lock);
 }
 
-// this function is like regular strtok, but faster
-// the delimiter list is, implicitly, spaces
-static char *my_strtok(char *str)
+static struct tile *tile_loaded(struct tile *t)
 {
-    static char *next; // points to the remaining part of the string
-    char *begin = str ? str : next, *s = begin;
-    if (!*s)
-        return NULL;
-    while (*s && !my_isspace(*s))
-        s++;
-    if (!*s)
-        return begin;
-    assert(my_isspace(*s));
-    while(*s && my_isspace(*s))
-        s++;
-    if (!*s)
-        return begin;
-    assert(!my_isspace(*s));
-    s--;
-    *s = '\0';
-    next = s + 1;
-    return begin;
-}
-
-// parse a tile file into memory
-// (this function is ugly due to the error checking)
-static float *malloc_tile_data(char *tile_filename)
-{
-    int fsize;
-    char *f = malloc_file_contents(tile_filename, &fsize);
-    if (!f)
+    evict_tiles(t, TILE_BYTES);
+    cache_stats.tiles += 1;
+    cache_stats.bytes += TILE_BYTES;
+    return t;
+}
+
+// number of rows of the blocks of a tile: whole strips or rows of tiles of
+// its tif file, at least BLOCK_ROWS
+static int tiff_block_rows(TIFF *tif)
+{
+    uint32 n = 0;
+    if (TIFFIsTiled(tif))
+        TIFFGetField(tif, TIFFTAG_TILELENGTH, &n);
+    else
+        TIFFGetField(tif, TIFFTAG_ROWSPERSTRIP, &n);
+    if (n == 0 || n > TILE_SIZE)
+        return TILE_SIZE;
+    return n * ((BLOCK_ROWS + n - 1) / n);
+}
+
+// get a tile, with its samples mapped from its sidecar if any. Otherwise the
+// rows of the tile are not decoded yet, see load_rows. With quiet, a missing
+// tile is neither counted nor reported. Called with tiles_lock held
+static struct tile *produce_tile(int tlon, int tlat, bool quiet)
+{
+    struct tile *t = &global_table_of_tiles[tlon][tlat];
+    t->last_use = ++cache_clock;
+    if (t->data) {
+        cache_stats.hits += 1;
+        return t;
+    }
+    char fname[FILENAME_MAX], npy[FILENAME_MAX];
+    get_tile_filename(fname, tlon, tlat, SRTM4_TIF);
+    if (quiet && !file_exists(fname))
         return NULL;
-    int finc, ncols, nrows, xllcorner, yllcorner;
-    double cellsize, nodatavalue;
-    cellsize=nodatavalue=finc=ncols=nrows=xllcorner=yllcorner=-42;
 
-    int r = sscanf(f, "ncols %d\nnrows %d\nxllcorner %d\nyllcorner %d\n"
-            "cellsize %lf\nNODATA_value %lf\n%n", &ncols, &nrows,
-            &xllcorner, &yllcorner, &cellsize, &nodatavalue, &finc);
+    cache_stats.misses += 1;
+    t->data = map_sidecar(get_tile_filename(npy, tlon, tlat, SRTM4_NPY), t);
+    if (t->data) {
+        t->complete = true;
+        return tile_loaded(t);
+    }
 
-    if (r != 6) {
-        fprintf(stderr, "strange tile file format on \"%s\" (%d)\n",
-                tile_filename, r);
-        exit(2);
+    if (!file_exists(fname)) {
+        fprintf(stderr, "WARNING: this srtm tile is not available\n");
+        return NULL;
     }
-    if (ncols != 6000 || nrows != 6000) {
-        fprintf(stderr,"ncols,nrows = %d,%d != 6000,6000",ncols,nrows);
-        exit(2);
+    TIFFSetWarningHandler(NULL); //suppress warnings
+    TIFF *tif = TIFFOpen(fname, "r");
+    if (!tif) {
+        fprintf(stderr, "failed to read the tif file\n");
+        abort();
     }
-    int n = 6000*6000;
-    float *t = malloc(n*sizeof*t);
-    if (!t) {
-        fprintf(stderr, "out of memory!\n");
-        exit(2);
+    uint32 w = 0, h = 0;
+    TIFFGetField(tif, TIFFTAG_IMAGEWIDTH, &w);
+    TIFFGetField(tif, TIFFTAG_IMAGELENGTH, &h);
+    if ((w != TILE_SIZE) || (h != TILE_SIZE)) {
+        fprintf(stderr, "produce_tile: tif srtm file isn't 6000x6000\n");
+        abort();
     }
-    int cx = 0;
-    char *fp = f + finc;
-    char *tok = my_strtok(fp);
-    while (tok && cx < n) {
-        int x = my_atoi(tok);
-        t[cx++] = x > -1000 ? x : NAN;
-        tok = my_strtok(NULL);
-    }
-    free(f);
-    if (cx != n) {
-        fprintf(stderr, "could only read %d numbers from file \n", cx);
-        exit(2);
+    t->block_rows = tiff_block_rows(tif);
+
+    // the pages of the samples are only allocated when they are decoded
+    t->tif = tif;
+    t->path = (char *) malloc(strlen(fname) + 1);
+    strcpy(t->path, fname);
+    t->nblocks = (TILE_SIZE + t->block_rows - 1) / t->block_rows;
+    t->nloaded = 0;
+    t->loaded = (bool *) calloc(t->nblocks, sizeof*t->loaded);
+    t->data = (int16_t *) malloc(TILE_BYTES);
+    t->complete = false;
+    return tile_loaded(t);
+}
+
+// all the rows of a tile are decoded. Called with the lock of the tile held
+static void tile_complete(struct tile *t)
+{
+    free(t->loaded);
+    t->loaded = NULL;
+    TIFFClose(t->tif);
+    t->tif = NULL;
+    __atomic_store_n(&t->complete, true, __ATOMIC_RELEASE);
+
+    // publish the sidecar and use it, so that the pages of the tile are
+    // shared through the page cache by all the processes of the host. The
+    // decoded samples are kept while other threads may be reading them
+    char npy[FILENAME_MAX];
+    snprintf(npy, FILENAME_MAX, "%.*s.npy", (int) strlen(t->path) - 4,
+            t->path);
+    if (sidecars_enabled() && write_sidecar(npy, t->data)) {
+        pthread_mutex_lock(&tiles_lock);
+        if (t->refs == 1) {
+            int16_t *data = map_sidecar(npy, t);
+            if (data) {
+                free(t->data);
+                t->data = data;
+            }
+        }
+        pthread_mutex_unlock(&tiles_lock);
     }
-    return t;
 }
 
-static void cast_int16_to_float(float *out, int16_t *in, int n)
+// decode the rows j0 to j1 of a pinned tile, if they are not there yet
+static void load_rows(struct tile *t, int tlon, int tlat, int j0, int j1)
 {
-    for (int i = 0; i < n; i++)
-        out[i] = (float) in[i];
+    pthread_once(&tile_locks_once, init_tile_locks);
+    pthread_mutex_lock(&tile_locks[tlon][tlat]);
+    if (t->complete) {
+        pthread_mutex_unlock(&tile_locks[tlon][tlat]);
+        return;
+    }
+
+    if (j0 < 0) j0 = 0;
+    if (j1 >= TILE_SIZE) j1 = TILE_SIZE - 1;
+    for (int b = j0 / t->block_rows; b <= j1 / t->block_rows; b++) {
+        if (t->loaded[b])
+            continue;
+        int r0 = b * t->block_rows;
+        int r1 = r0 + t->block_rows < TILE_SIZE ? r0 + t->block_rows
+                                                : TILE_SIZE;
+        if (!read_tiff_rows(t->tif, t->data, TILE_SIZE, r0, r1)) {
+            fprintf(stderr, "failed to read the tif file\n");
+            abort();
+        }
+        t->loaded[b] = true;
+        t->nloaded += 1;
+        __atomic_add_fetch(&cache_stats.blocks, 1, __ATOMIC_RELAXED);
+    }
+    if (t->nloaded == t->nblocks)
+        tile_complete(t);
+    pthread_mutex_unlock(&tile_locks[tlon][tlat]);
 }
 
-static float *global_table_of_tiles[360][180] = {{0}};
+// a tile pinned by a thread. The lookups of the next points in the same tile
+// reuse the pin without taking tiles_lock, and count their hits in it
+struct pin {
+    struct tile *t;
+    int tlon, tlat;
+    unsigned long long hits;
+};
 
-static float *produce_tile(int tlon, int tlat, bool tif)
+static void unpin(struct pin *p)
 {
-    float *t = global_table_of_tiles[tlon][tlat];
-    if (!t) {
-        char *fname = get_tile_filename(tlon, tlat, tif);
-        if (!file_exists(fname)) {
-            fprintf(stderr, "WARNING: this srtm tile is not available\n");
+    if (!p->t)
+        return;
+    pthread_mutex_lock(&tiles_lock);
+    p->t->refs -= 1;
+    p->t->last_use = ++cache_clock;
+    cache_stats.hits += p->hits;
+    if (!p->t->refs)
+        evict_tiles(NULL, 0);
+    pthread_mutex_unlock(&tiles_lock);
+    p->t = NULL;
+    p->hits = 0;
+}
+
+// pin the tile (tlon, tlat) in p, and get its samples, with at least its rows
+// j0 to j1 decoded
+static const int16_t *produce_rows(struct pin *p, int tlon, int tlat,
+        int j0, int j1, bool quiet)
+{
+    if (p->t && p->tlon == tlon && p->tlat == tlat) {
+        p->hits += 1;
+    } else {
+        unpin(p);
+        pthread_mutex_lock(&tiles_lock);
+        struct tile *t = produce_tile(tlon, tlat, quiet);
+        if (t)
+            t->refs += 1;
+        pthread_mutex_unlock(&tiles_lock);
+        if (!t)
             return NULL;
-        }
-        if (tif) {
-            int w, h;
-            int16_t *tmp = read_tiff_int16_gray(fname, &w, &h);
-            if (NULL == tmp) {
-                fprintf(stderr, "failed to read the tif file\n");
-                abort();
-            }
-            if ((w != 6000) || (h != 6000)) {
-                fprintf(stderr, "produce_tile: tif srtm file isn't 6000x6000\n");
-                abort();
-            }
-            t = malloc(w*h*sizeof*t);
-            cast_int16_to_float(t, tmp, w*h);
-        }
-        else
-            t = malloc_tile_data(fname);
-        global_table_of_tiles[tlon][tlat] = t;
+        *p = (struct pin) {t, tlon, tlat, 0};
     }
-    return t;
+    if (!__atomic_load_n(&p->t->complete, __ATOMIC_ACQUIRE))
+        load_rows(p->t, tlon, tlat, j0, j1);
+    return p->t->data;
+}
+
+// export the sidecar of the tile (tlon, tlat) of the cache directory dir,
+// return 0 on success. The tif file is decoded on its own, so that neither
+// the cache directory nor the tiles loaded from it are changed
+int srtm4_write_sidecar(const char *dir, int tlon, int tlat)
+{
+    if (tlon < 1 || tlon > 72 || tlat < 1 || tlat > 24 || !sidecars_enabled())
+        return 1;
+    char tif[FILENAME_MAX], npy[FILENAME_MAX];
+    snprintf(tif, FILENAME_MAX, SRTM4_TIF, dir, tlon, tlat);
+    snprintf(npy, FILENAME_MAX, SRTM4_NPY, dir, tlon, tlat);
+    int w, h;
+    int16_t *data = read_tiff_int16_gray(tif, &w, &h);
+    if (!data)
+        return 1;
+    int r = w != TILE_SIZE || h != TILE_SIZE || !write_sidecar(npy, data);
+    free(data);
+    return r;
 }
 
 static float evaluate_bilinear_cell(float a, float b, float c, float d,
@@ -304,7 +607,7 @@ static float evaluate_bilinear_cell(float a, float b, float c, float d,
     return r;
 }
 
-static float getpixel_1(float *x, int w, int h, int i, int j)
+static float getpixel_1(const int16_t *x, int w, int h, int i, int j)
 {
     if (i < 0) i = 0;
     if (j < 0) j = 0;
@@ -317,7 +620,8 @@ static float getpixel_1(float *x, int w, int h, int i, int j)
         return out;
 }
 
-static float bilinear_interpolation_at(float *x, int w, int h, float p, float q)
+static float bilinear_interpolation_at(const int16_t *x,
+        int w, int h, float p, float q)
 {
     int ip = p;
     int iq = q;
@@ -329,7 +633,7 @@ static float bilinear_interpolation_at(float *x, int w, int h, float p, float q)
     return r;
 }
 
-static float nearest_neighbor_interpolation_at(float *x,
+static float nearest_neighbor_interpolation_at(const int16_t *x,
         int w, int h, float p, float q)
 {
     int ip = rintf(p);
@@ -338,7 +642,76 @@ static float nearest_neighbor_interpolation_at(float *x,
     return r;
 }
 
-double srtm4(double lon, double lat, int interpolation)
+// pixel (i, j) of tile (tlon, tlat), where i and j may fall in the
+// neighbouring tiles, one tile away at most. The longitudes wrap around the
+// antimeridian, the latitudes are clamped to the coverage, and missing tiles
+// are sea. The neighbouring tiles are pinned in q.
+static float getpixel_across_tiles(struct pin *q, int tlon, int tlat,
+        int i, int j)
+{
+    if (i < 0) {
+        i += TILE_SIZE;
+        tlon = tlon == 1 ? 72 : tlon - 1;
+    }
+    if (i >= TILE_SIZE) {
+        i -= TILE_SIZE;
+        tlon = tlon == 72 ? 1 : tlon + 1;
+    }
+    if (j < 0 && tlat > 1) {
+        j += TILE_SIZE;
+        tlat -= 1;
+    }
+    if (j >= TILE_SIZE && tlat < 24) {
+        j -= TILE_SIZE;
+        tlat += 1;
+    }
+    // no warning for the missing neighbours
+    const int16_t *t = produce_rows(q, tlon, tlat, j, j, true);
+    if (t == NULL)
+        return 0;
+    return getpixel_1(t, TILE_SIZE, TILE_SIZE, i, j);
+}
+
+// weights of the 4 samples around x in [0, 1) for the cubic convolution
+// kernel of Keys (a = -0.5)
+static void cubic_weights(float w[4], float x)
+{
+    w[0] = ((-0.5f * x + 1) * x - 0.5f) * x;
+    w[1] = (1.5f * x - 2.5f) * x * x + 1;
+    w[2] = ((-1.5f * x + 2) * x + 0.5f) * x;
+    w[3] = (0.5f * x - 0.5f) * x * x;
+}
+
+static float bicubic_interpolation_at(const int16_t *x, struct pin *n,
+        int tlon, int tlat, float p, float q)
+{
+    int ip = p;
+    int iq = q;
+    float wx[4], wy[4];
+    cubic_weights(wx, p - ip);
+    cubic_weights(wy, q - iq);
+
+    // on the borders of the tile, the 4x4 neighbourhood is read from the
+    // neighbouring tiles, pinned in n (x stays pinned by the caller)
+    bool inside = ip >= 1 && iq >= 1 && ip + 2 < TILE_SIZE && iq + 2 < TILE_SIZE;
+    float r = 0;
+    for (int j = 0; j < 4; j++) {
+        float row = 0;
+        for (int i = 0; i < 4; i++) {
+            float v = inside
+                ? getpixel_1(x, TILE_SIZE, TILE_SIZE, ip - 1 + i, iq - 1 + j)
+                : getpixel_across_tiles(n, tlon, tlat, ip - 1 + i, iq - 1 + j);
+            row += wx[i] * v;
+        }
+        r += wy[j] * row;
+    }
+    return r;
+}
+
+// height of a point, with its tile pinned in p and, for the bicubic
+// interpolation on the borders of the tiles, the neighbouring tiles in n
+static double height_at(struct pin *p, struct pin *n, double lon, double lat,
+        int interpolation)
 {
     if (lat > 60 || lat < -60) {
         return NO_DATA;
@@ -346,19 +719,34 @@ double srtm4(double lon, double lat, int interpolation)
     int tlon, tlat;
     float xlon, xlat;
     get_tile_index_and_position(&tlon, &tlat, &xlon, &xlat, lon, lat);
-    float *t = produce_tile(tlon, tlat, true);
+    // the rows read by the interpolations
+    const int16_t *t = produce_rows(p, tlon, tlat, (int) xlat - 1,
+            (int) xlat + 2, false);
     if (t == NULL)
         return NO_DATA;
 
+    // interpolation: 0 nearest, 1 bilinear, 2 bicubic
     float r;
     if (interpolation == 0) {
-        r = nearest_neighbor_interpolation_at(t, 6000, 6000, xlon, xlat);
-    } else if (interpolation >= 1) {
-        r = bilinear_interpolation_at(t, 6000, 6000, xlon, xlat);
+        r = nearest_neighbor_interpolation_at(t, TILE_SIZE, TILE_SIZE,
+                xlon, xlat);
+    } else if (interpolation == 2) {
+        r = bicubic_interpolation_at(t, n, tlon, tlat, xlon, xlat);
+    } else {
+        r = bilinear_interpolation_at(t, TILE_SIZE, TILE_SIZE, xlon, xlat);
     }
     return r;
 }
 
+double srtm4(double lon, double lat, int interpolation)
+{
+    struct pin p = {0}, n = {0};
+    double r = height_at(&p, &n, lon, lat, interpolation);
+    unpin(&p);
+    unpin(&n);
+    return r;
+}
+
 double srtm4_wrt_ellipsoid(double lon, double lat, int interpolation)
 {
     double srtm = srtm4(lon, lat, interpolation);
@@ -368,32 +756,321 @@ double srtm4_wrt_ellipsoid(double lon, double lat, int interpolation)
     return srtm + geoid;
 }
 
+// the points [i0, i1) of a batch, evaluated by one thread
+struct batch_part {
+    double *out;
+    const double *lon, *lat;
+    long i0, i1;
+    int interpolation, wrt_ellipsoid;
+};
+
+// number of geoid heights evaluated at once by each thread of a batch
+#define GEOID_CHUNK 1024
+
+static void *batch_part(void *arg)
+{
+    struct batch_part *b = arg;
+    struct pin p = {0}, n = {0};
+    for (long i = b->i0; i < b->i1; i++)
+        b->out[i] = height_at(&p, &n, b->lon[i], b->lat[i], b->interpolation);
+    unpin(&p);
+    unpin(&n);
+    if (b->wrt_ellipsoid)
+        for (long i = b->i0; i < b->i1; i += GEOID_CHUNK) {
+            double geoid[GEOID_CHUNK];
+            long m = b->i1 - i < GEOID_CHUNK ? b->i1 - i : GEOID_CHUNK;
+            geoid_heights(geoid, b->lat + i, b->lon + i, m);
+            for (long k = 0; k < m; k++)
+                b->out[i + k] += geoid[k];
+        }
+    return NULL;
+}
+
+// minimal number of points evaluated by each thread of a batch
+#define BATCH_MIN_POINTS 16384
+
+// number of threads of the batches: SRTM4_THREADS, or the number of cores
+static long batch_threads(void)
+{
+    char *env = getenv("SRTM4_THREADS");
+    long n = env ? atol(env) : 0;
+    if (n <= 0)
+        n = sysconf(_SC_NPROCESSORS_ONLN);
+    return n > 0 ? n : 1;
+}
+
+// evaluate the heights of n points, w.r.t. the ellipsoid if requested. The
+// points are split in contiguous ranges evaluated by parallel threads
+void srtm4_batch(double *out, const double *lon, const double *lat, long n,
+        int interpolation, int wrt_ellipsoid)
+{
+    long nthreads = batch_threads();
+    if (nthreads > n / BATCH_MIN_POINTS)
+        nthreads = n / BATCH_MIN_POINTS;
+    struct batch_part *parts = NULL;
+    pthread_t *threads = NULL;
+    if (nthreads > 1) {
+        parts = malloc(nthreads * sizeof*parts);
+        threads = malloc(nthreads * sizeof*threads);
+    }
+    if (!parts || !threads) {
+        struct batch_part b = {out, lon, lat, 0, n, interpolation,
+                               wrt_ellipsoid};
+        batch_part(&b);
+        free(parts);
+        free(threads);
+        return;
+    }
+
+    for (long k = 0; k < nthreads; k++)
+        parts[k] = (struct batch_part) {out, lon, lat, n / nthreads * k,
+            k + 1 < nthreads ? n / nthreads * (k + 1) : n,
+            interpolation, wrt_ellipsoid};
+    // the first range is evaluated by the calling thread, and the others too
+    // if their thread cannot be started
+    for (long k = 1; k < nthreads; k++)
+        if (pthread_create(&threads[k], NULL, batch_part, &parts[k])) {
+            batch_part(&parts[k]);
+            parts[k].out = NULL;
+        }
+    batch_part(&parts[0]);
+    for (long k = 1; k < nthreads; k++)
+        if (parts[k].out)
+            pthread_join(threads[k], NULL);
+    free(parts);
+    free(threads);
+}
+
+// unload the tiles, except those pinned. Called with tiles_lock held
+static void free_tiles(void)
+{
+    for (int j = 1; j <= 72; j++)
+    for (int i = 1; i <= 24; i++) {
+        struct tile *t = &global_table_of_tiles[j][i];
+        if (t->data && !t->refs)
+            unload_tile(t);
+    }
+}
+
 void srtm4_free_tiles(void)
 {
-    for (int j = 0; j < 360; j++)
-    for (int i = 0; i < 180; i++)
-        if (global_table_of_tiles[j][i])
-            free(global_table_of_tiles[j][i]);
+    pthread_mutex_lock(&tiles_lock);
+    free_tiles();
+    pthread_mutex_unlock(&tiles_lock);
 }
 
+
 #ifdef MAIN_SRTM4
+#include <poll.h>
+#include <signal.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+// Server mode: the tiles and the geoid stay loaded between the queries of
+// many client processes, connected through a unix socket.
+//
+// A request is a header {uint32 magic, uint32 flags, uint64 n} followed by
+// the n longitudes and the n latitudes, as float64. Bit 0 of the flags asks
+// for heights w.r.t. the ellipsoid, bits 8 to 15 hold the interpolation.
+// The reply is a header {magic, status, n} followed by the n heights.
+// Everything is in the native byte order of the host.
+#define SERVER_MAGIC 0x34545253 // "SRT4"
+#define SERVER_SOCKET "srtm4.sock"
+#define SERVER_MAX_CLIENTS 255
+
+struct server_header {
+    uint32_t magic, flags;
+    uint64_t n;
+};
+
+static char server_socket_path[sizeof(((struct sockaddr_un *)0)->sun_path)];
+
+static bool read_all(int fd, void *buf, size_t size)
+{
+    char *p = buf;
+    while (size > 0) {
+        ssize_t r = read(fd, p, size);
+        if (r < 0 && errno == EINTR)
+            continue;
+        if (r <= 0)
+            return false;
+        p += r;
+        size -= r;
+    }
+    return true;
+}
+
+static bool write_all(int fd, const void *buf, size_t size)
+{
+    const char *p = buf;
+    while (size > 0) {
+        ssize_t r = write(fd, p, size);
+        if (r < 0 && errno == EINTR)
+            continue;
+        if (r <= 0)
+            return false;
+        p += r;
+        size -= r;
+    }
+    return true;
+}
+
+// answer one request of a client, return false to close the connection
+static bool serve_request(int fd)
+{
+    struct server_header h;
+    if (!read_all(fd, &h, sizeof h) || h.magic != SERVER_MAGIC)
+        return false;
+    size_t n = h.n;
+    if (n > SIZE_MAX / (3 * sizeof(double)))
+        return false;
+    double *buf = malloc((3 * n + 1) * sizeof(double));
+    if (!buf)
+        return false;
+    double *lon = buf, *lat = buf + n, *out = buf + 2 * n;
+    bool ok = read_all(fd, lon, 2 * n * sizeof(double));
+    if (ok) {
+        srtm4_batch(out, lon, lat, n, (h.flags >> 8) & 0xff, h.flags & 1);
+        struct server_header r = {SERVER_MAGIC, 0, n};
+        ok = write_all(fd, &r, sizeof r)
+            && write_all(fd, out, n * sizeof(double));
+    }
+    free(buf);
+    return ok;
+}
+
+static void remove_server_socket(int sig)
+{
+    unlink(server_socket_path);
+    _exit(128 + sig);
+}
+
+static int bind_server_socket(const char *path)
+{
+    struct sockaddr_un addr = {.sun_family = AF_UNIX};
+    if (strlen(path) >= sizeof addr.sun_path) {
+        fprintf(stderr, "SRTM4: socket path too long \"%s\"\n", path);
+        return -1;
+    }
+    strcpy(addr.sun_path, path);
+    int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (fd < 0)
+        return -1;
+
+    // a socket file left by a dead server is removed, a live one is kept
+    if (0 == connect(fd, (struct sockaddr *)&addr, sizeof addr)) {
+        fprintf(stderr, "SRTM4: a server is already listening on \"%s\"\n",
+                path);
+        close(fd);
+        return -1;
+    }
+    unlink(path);
+    if (bind(fd, (struct sockaddr *)&addr, sizeof addr)
+            || listen(fd, SOMAXCONN)) {
+        fprintf(stderr, "SRTM4: cannot listen on \"%s\": %s\n", path,
+                strerror(errno));
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+static int serve(const char *path)
+{
+    int listener = bind_server_socket(path);
+    if (listener < 0)
+        return 1;
+    strcpy(server_socket_path, path);
+    signal(SIGINT, remove_server_socket);
+    signal(SIGTERM, remove_server_socket);
+    signal(SIGPIPE, SIG_IGN);
+    fprintf(stderr, "SRTM4: listening on \"%s\"\n", path);
+
+    struct pollfd fds[1 + SERVER_MAX_CLIENTS];
+    int nfds = 1;
+    fds[0] = (struct pollfd){.fd = listener, .events = POLLIN};
+    while (1) {
+        if (poll(fds, nfds, -1) < 0) {
+            if (errno == EINTR)
+                continue;
+            break;
+        }
+        // each ready client is served one whole request at a time
+        for (int i = nfds - 1; i > 0; i--)
+            if (fds[i].revents && !serve_request(fds[i].fd)) {
+                close(fds[i].fd);
+                fds[i] = fds[--nfds];
+            }
+        if (fds[0].revents & POLLIN) {
+            int fd = accept(listener, NULL, NULL);
+            if (fd >= 0 && nfds < 1 + SERVER_MAX_CLIENTS)
+                fds[nfds++] = (struct pollfd){.fd = fd, .events = POLLIN};
+            else if (fd >= 0)
+                close(fd);
+        }
+    }
+    unlink(path);
+    return 1;
+}
+
 int main(int c, char *v[])
 {
-    if (c != 1 && c != 3) {
-        fprintf(stderr, "usage:\n\t%s longitude latitude\n", *v);
+    // with -s, serve the queries of other processes on a unix socket
+    const char *prog = *v;
+    if (c > 1 && 0 == strcmp(v[1], "-s")) {
+        if (c > 3) {
+            fprintf(stderr, "usage:\n\t%s -s [socket]\n", prog);
+            return 1;
+        }
+        if (c == 3)
+            return serve(v[2]);
+        char path[FILENAME_MAX];
+        char dirname[FILENAME_MAX];
+        snprintf(path, FILENAME_MAX, "%s/%s", cachedir(dirname),
+                SERVER_SOCKET);
+        return serve(path);
+    }
+
+    // with -o, the heights are given w.r.t. the geoid (orthometric)
+    // with -i, the interpolation is nearest, bilinear (default) or bicubic
+    bool wrt_ellipsoid = true;
+    int interpolation = 1;
+    const char *interpolations[] = {"nearest", "bilinear", "bicubic"};
+    while (c > 1 && (0 == strcmp(v[1], "-o") || 0 == strcmp(v[1], "-i"))) {
+        if (0 == strcmp(v[1], "-o")) {
+            wrt_ellipsoid = false;
+            c -= 1;
+            v += 1;
+            continue;
+        }
+        interpolation = -1;
+        for (int i = 0; c > 2 && i < 3; i++)
+            if (0 == strcmp(v[2], interpolations[i]))
+                interpolation = i;
+        if (interpolation < 0)
+            break;
+        c -= 2;
+        v += 2;
+    }
+    if (interpolation < 0 || (c != 1 && c != 3)) {
+        fprintf(stderr, "usage:\n\t%s [-o] [-i nearest|bilinear|bicubic] "
+                        "longitude latitude\n"
+                        "\t%s -s [socket]\n", prog, prog);
         return 1;
     }
     if (c == 3) {
         double lon = atof(v[1]);
         double lat = atof(v[2]);
-        double r = srtm4_wrt_ellipsoid(lon, lat, 1);
+        double r = wrt_ellipsoid ? srtm4_wrt_ellipsoid(lon, lat, interpolation)
+                                 : srtm4(lon, lat, interpolation);
         printf("%g\n", r);
         return 0;
     }
     else {
         double lon, lat, r;
         while(2 == scanf("%lf %lf\n", &lon, &lat)) {
-            r = srtm4_wrt_ellipsoid(lon, lat, 1);
+            r = wrt_ellipsoid ? srtm4_wrt_ellipsoid(lon, lat, interpolation)
+                              : srtm4(lon, lat, interpolation);
             printf("%g\n", r);
         }
     }
@@ -1,9 +1,38 @@
 from srtm4.download import get_srtm_tile
+from srtm4.download import get_srtm_tiles
 from srtm4.point import SRTM_DIR
 from srtm4.point import srtm4_which_tile
+from srtm4.point import srtm4_which_tiles
 from srtm4.point import srtm4
+from srtm4.point import srtm4_iter
+from srtm4.point import srtm4_file
+from srtm4.point import srtm4_grid
+from srtm4.point import profile
+from srtm4.point import prefetch
+from srtm4.point import tile_cache_stats
+from srtm4.point import set_max_tile_bytes
+from srtm4.geoid import geoid_height
+from srtm4.metrics import stats
+from srtm4.metrics import reset_stats
+from srtm4.metrics import set_stats_callback
 
-try:
-    from srtm4.raster import crop
-except ImportError:  # optional requirements were not installed
-    pass
+# the raster helpers need the optional requirements (rasterio, affine), which
+# are slow to import: they are imported on first access
+_RASTER = ('crop', 'crop_to_file', 'write_crop_to_file')
+
+
+def __getattr__(name):
+    if name in _RASTER:
+        # without the crop extras, hasattr(srtm4, 'crop') is False
+        try:
+            from srtm4 import raster
+        except ImportError as e:
+            raise AttributeError(
+                "srtm4.{} needs the crop extras, install them with pip "
+                "install srtm4[crop] ({})".format(name, e)) from e
+        return getattr(raster, name)
+    raise AttributeError("module 'srtm4' has no attribute {!r}".format(name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_RASTER))
@@ -0,0 +1,111 @@
+"""
+Command line interface of srtm4, to fill and check a cache of tiles before
+it is used:
+
+    python -m srtm4 warm --bounds 2 47 7 48
+    python -m srtm4 warm --tiles srtm_37_03 srtm_38_03 --base-url file:///mirror
+    python -m srtm4 check
+"""
+import argparse
+import os
+import re
+import sys
+
+from srtm4 import download
+from srtm4 import point
+
+
+def _tile_name(name):
+    if not re.fullmatch(r'srtm_\d\d_\d\d', name):
+        raise argparse.ArgumentTypeError(
+            "{} does not follow the pattern srtm_XX_YY".format(name))
+    return name
+
+
+def warm(args):
+    """
+    Download the tiles of bounds or of a list into the cache, in parallel, and
+    record them in the manifest of the cache.
+    """
+    if args.bounds:
+        names = ['srtm_{:02d}_{:02d}'.format(*t)
+                 for t in point.tiles_in_bounds(args.bounds)]
+    else:
+        names = args.tiles
+
+    try:
+        present = download.get_srtm_tiles(names, args.cache,
+                                          max_workers=args.workers,
+                                          skip_unavailable=args.skip_unavailable,
+                                          base_url=args.base_url,
+                                          tiled=args.tiled or None)
+    except ConnectionError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.tiled:
+        # the tiles that were already there
+        for name in present:
+            download.retile(os.path.join(os.path.expanduser(args.cache),
+                                         name + '.tif'))
+    tiles = download.write_manifest(args.cache, present)
+    for name in present:
+        print('{} {} {}'.format(name, tiles[name]['size'],
+                                tiles[name]['sha256']))
+    for name in sorted(set(names) - set(present)):
+        print('{} not available'.format(name), file=sys.stderr)
+    return 0
+
+
+def check(args):
+    """
+    Check the tiles of the cache against its manifest.
+    """
+    tiles = download.read_manifest(args.cache)
+    bad = download.check_manifest(args.cache)
+    for name in bad:
+        print('{} missing or corrupted'.format(name), file=sys.stderr)
+    print('{} of {} tiles ok'.format(len(tiles) - len(bad), len(tiles)))
+    return 1 if bad else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m srtm4')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('warm', help='download tiles into the cache')
+    which = p.add_mutually_exclusive_group(required=True)
+    which.add_argument('--bounds', type=float, nargs=4,
+                       metavar=('LON_MIN', 'LAT_MIN', 'LON_MAX', 'LAT_MAX'),
+                       help='download the tiles intersecting these bounds')
+    which.add_argument('--tiles', type=_tile_name, nargs='+',
+                       metavar='srtm_XX_YY', help='download these tiles')
+    p.add_argument('--base-url', default=None,
+                   help='url of the srtm_XX_YY.zip archives, http(s):// or '
+                        'file://, instead of $SRTM4_URL or the SRTM server')
+    p.add_argument('--workers', type=int, default=8,
+                   help='maximum number of concurrent downloads')
+    p.add_argument('--skip-unavailable', action='store_true',
+                   help='skip the tiles that are not available, e.g. over '
+                        'the sea, instead of failing')
+    p.add_argument('--tiled', action='store_true',
+                   help='re-encode the tiles as tiled, compressed GeoTIFF '
+                        'files (needs rasterio)')
+    p.set_defaults(func=warm)
+
+    p = commands.add_parser('check',
+                            help='check the tiles of the cache against its '
+                                 'manifest')
+    p.set_defaults(func=check)
+
+    for p in commands.choices.values():
+        p.add_argument('--cache', default=point.SRTM_DIR,
+                       help='cache directory, instead of $SRTM4_CACHE or '
+                            '~/.srtm')
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+In-process bindings to the srtm4 C library (bin/libsrtm4.so).
+
+The arrays are handed to the library without copies, and ctypes releases
+the GIL for the duration of each call.
+"""
+import ctypes
+import os
+import threading
+
+import numpy as np
+
+LIB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   'bin', 'libsrtm4.so')
+
+_f64 = np.ctypeslib.ndpointer(dtype=np.float64, flags='C_CONTIGUOUS')
+
+_lib = None
+_lib_loaded = False
+_lib_lock = threading.Lock()
+
+
+class TileCacheStats(ctypes.Structure):
+    """Counters of the tile cache of the library."""
+    _fields_ = [('hits', ctypes.c_ulonglong),
+                ('misses', ctypes.c_ulonglong),
+                ('evictions', ctypes.c_ulonglong),
+                ('tiles', ctypes.c_ulonglong),
+                ('bytes', ctypes.c_ulonglong),
+                ('max_bytes', ctypes.c_ulonglong),
+                ('blocks', ctypes.c_ulonglong)]
+
+
+def load():
+    """
+    Load the srtm4 shared library once, also when the first calls come from
+    several threads at once.
+
+    Returns:
+        ctypes.CDLL, or None if the library was not built
+    """
+    global _lib, _lib_loaded
+    if _lib_loaded:
+        return _lib
+    with _lib_lock:
+        if not _lib_loaded:
+            _lib = _load()
+            _lib_loaded = True
+    return _lib
+
+
+def _load():
+    try:
+        lib = ctypes.CDLL(LIB)
+    except OSError:
+        return None
+
+    lib.srtm4_set_cachedir.argtypes = [ctypes.c_char_p]
+    lib.srtm4_set_cachedir.restype = None
+    lib.geoid_set_path.argtypes = [ctypes.c_char_p]
+    lib.geoid_set_path.restype = None
+    lib.srtm4_batch.argtypes = [_f64, _f64, _f64, ctypes.c_long,
+                                ctypes.c_int, ctypes.c_int]
+    lib.srtm4_batch.restype = None
+    lib.geoid_heights.argtypes = [_f64, _f64, _f64, ctypes.c_long]
+    lib.geoid_heights.restype = None
+    lib.srtm4_write_sidecar.argtypes = [ctypes.c_char_p, ctypes.c_int,
+                                        ctypes.c_int]
+    lib.srtm4_write_sidecar.restype = ctypes.c_int
+    lib.srtm4_set_max_tile_bytes.argtypes = [ctypes.c_ulonglong]
+    lib.srtm4_set_max_tile_bytes.restype = None
+    lib.srtm4_tile_cache_stats.argtypes = [ctypes.POINTER(TileCacheStats)]
+    lib.srtm4_tile_cache_stats.restype = None
+    lib.srtm4_reset_tile_cache_stats.argtypes = []
+    lib.srtm4_reset_tile_cache_stats.restype = None
+    lib.srtm4_free_tiles.argtypes = []
+    lib.srtm4_free_tiles.restype = None
+    lib.geoid_evaluations.argtypes = [ctypes.c_int]
+    lib.geoid_evaluations.restype = ctypes.c_ulonglong
+    return lib
+
+
+def as_f64(a):
+    """
+    View the input as a flat contiguous float64 array (copy only if needed).
+    """
+    return np.ascontiguousarray(a, dtype=np.float64).reshape(-1)
+
+
+def check_out(out, size):
+    """
+    Check that a caller-supplied output array can be filled in place.
+
+    Returns:
+        flat float64 view of out
+    """
+    if not isinstance(out, np.ndarray) or out.dtype != np.float64 \
+            or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous float64 ndarray")
+    if out.size != size:
+        raise ValueError("out has size {}, expected {}".format(out.size, size))
+    return out.reshape(-1)
+
+
+def srtm4_batch(lib, lon, lat, out, cache_dir, geoid_dir, interpolation=1,
+                wrt_ellipsoid=True):
+    """
+    Evaluate the heights of flat float64 arrays of points into out.
+    """
+    lib.srtm4_set_cachedir(cache_dir.encode())
+    lib.geoid_set_path(geoid_dir.encode())
+    lib.srtm4_batch(out, lon, lat, lon.size, interpolation, int(wrt_ellipsoid))
+    return out
+
+
+def geoid_heights(lib, lon, lat, out, geoid_dir):
+    """
+    Evaluate the EGM96 geoid heights of flat float64 arrays of points into out.
+    """
+    lib.geoid_set_path(geoid_dir.encode())
+    lib.geoid_heights(out, lat, lon, lon.size)
+    return out
+
+
+def tile_cache_stats(lib):
+    """
+    Read the counters of the tile cache of the library.
+
+    Returns:
+        dict with the hits, misses, evictions, tiles, bytes, max_bytes and
+        blocks
+    """
+    stats = TileCacheStats()
+    lib.srtm4_tile_cache_stats(ctypes.byref(stats))
+    return {name: getattr(stats, name) for name, _ in stats._fields_}
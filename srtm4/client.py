@@ -0,0 +1,91 @@
+"""
+Client of the srtm4 query server, started with `bin/srtm4 -s [socket]`.
+
+The server keeps the tiles and the geoid loaded for all the processes of the
+host. By default it listens on the socket srtm4.sock of its cache directory,
+so that the clients using the same cache find it. The SRTM4_SOCKET
+environment variable gives another path.
+
+The points are sent as a header (magic, flags, number of points) followed by
+the float64 longitudes and latitudes, and the server answers with a header
+and the float64 heights.
+"""
+import os
+import socket
+import struct
+import threading
+
+MAGIC = 0x34545253  # "SRT4"
+SOCKET_NAME = 'srtm4.sock'
+
+_HEADER = struct.Struct('=IIQ')
+
+# one connection per thread, reopened in forked processes
+_local = threading.local()
+
+
+def socket_path(cache_dir):
+    """Path of the socket of the server of a cache directory."""
+    return os.getenv('SRTM4_SOCKET') or os.path.join(cache_dir, SOCKET_NAME)
+
+
+def connect(path):
+    """
+    Connect to the server listening on a socket, reusing the connection of
+    the calling thread.
+
+    Returns:
+        socket.socket, or None if no server is listening
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        if _local.pid == os.getpid() and _local.path == path:
+            return conn
+        disconnect()
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+
+def disconnect():
+    """Close the connection of the calling thread, if any."""
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+
+
+def _recv_into(conn, buf):
+    view = memoryview(buf).cast('B')
+    while len(view):
+        n = conn.recv_into(view)
+        if n == 0:
+            raise ConnectionError("the srtm4 server closed the connection")
+        view = view[n:]
+
+
+def query(conn, lon, lat, out, interpolation=1, wrt_ellipsoid=True):
+    """
+    Evaluate the heights of flat float64 arrays of points into out.
+
+    Raises:
+        ConnectionError: if the server fails or closes the connection
+    """
+    flags = int(wrt_ellipsoid) | interpolation << 8
+    conn.sendall(_HEADER.pack(MAGIC, flags, lon.size))
+    conn.sendall(lon)
+    conn.sendall(lat)
+    header = bytearray(_HEADER.size)
+    _recv_into(conn, header)
+    magic, status, n = _HEADER.unpack(header)
+    if magic != MAGIC or status != 0 or n != lon.size:
+        raise ConnectionError("invalid reply of the srtm4 server")
+    _recv_into(conn, out)
+    return out
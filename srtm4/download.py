@@ -9,26 +9,61 @@ Copyright (C) 2016, Carlo de Franchis <carlo.de-franchis@ens-cachan.fr>
 """
 
 from __future__ import print_function
+import hashlib
+import json
 import zipfile
+import shutil
+import struct
 import sys
 import os
+import zlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
-import requests
-from requests.adapters import HTTPAdapter, Retry, RetryError
 import filelock
 
+from srtm4 import metrics
+
 SRTM_URL = 'https://srtm.csi.cgiar.org/wp-content/uploads/files/srtm_5x5/TIFF'
 
+# name of the file of the cache directory listing its tiles, see write_manifest
+MANIFEST = 'manifest.json'
+
+
+def tiled_enabled():
+    """
+    Tell whether the downloaded tiles are re-encoded as tiled GeoTIFF files
+    (SRTM4_TILED is set and not 0), see retile.
+    """
+    return os.getenv('SRTM4_TILED', '0') != '0'
+
+
+def srtm_url():
+    """
+    Base url of the srtm tiles: the SRTM4_URL environment variable if set,
+    e.g. an in-house mirror (http(s)://) or a local directory (file://),
+    and SRTM_URL otherwise. It holds the srtm_XX_YY.zip archives.
+    """
+    return os.getenv('SRTM4_URL') or SRTM_URL
+
 
 def _requests_retry_session(
         retries=5,
         backoff_factor=0.3,
         status_forcelist=(500, 502, 503, 504),
+        pool_maxsize=32,
 ):
     """
     Makes a requests object with built-in retry handling with
     exponential back-off on 5xx error codes.
     """
+    # requests is slow to import, and only needed for downloads
+    import requests
+    from requests.adapters import HTTPAdapter, Retry
+
     session = requests.Session()
     retry = Retry(
         total=retries,
@@ -37,12 +72,92 @@ def _requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
 
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """
+    Get the requests session shared by all the downloads of the process, so
+    that the connections to the server are kept alive and reused.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        # a session must not be shared with a forked child
+        if _session is None or _session_pid != os.getpid():
+            _session = _requests_retry_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+class _FileResponse(object):
+    """
+    Local file of a file:// url, read as a streamed requests.Response.
+    """
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        self.headers = {'content-length': str(size)}
+
+    def iter_content(self, chunk_size=1):
+        return iter(lambda: self._f.read(chunk_size), b'')
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _get(from_url, to_file):
+    """
+    Start the download of a file from the internet, or its copy from a
+    local directory for a file:// url.
+
+    Returns:
+        requests.Response, streaming the content of the file
+    """
+    if from_url.startswith('file://'):
+        path = url2pathname(urlparse(from_url).path)
+        try:
+            r = _FileResponse(path)
+        except OSError:
+            raise ConnectionError("File {} not found for url {}".format(
+                path, from_url))
+    else:
+        # Use a requests session with retry logic because the server at
+        # SRTM_URL sometimes returns 503 responses when overloaded
+        session = _get_session()
+        r = session.get(from_url, stream=True, verify=False)
+        if not r.ok:
+            r.close()
+            raise ConnectionError(
+                "Response code {} received for url {}".format(r.status_code,
+                                                              from_url)
+            )
+    file_size = int(r.headers['content-length'])
+    print("Downloading: {} Bytes: {}".format(to_file, file_size),
+          file=sys.stderr)
+    return r
+
+
+def _counted(chunks):
+    """Count the bytes of downloaded chunks in the stats."""
+    for chunk in chunks:
+        metrics.add('bytes_downloaded', len(chunk))
+        yield chunk
+
+
 def download(to_file, from_url):
     """
     Download a file from the internet.
@@ -56,32 +171,166 @@ def download(to_file, from_url):
             on 5xx codes
         ConnectionError: if the `get` call does not return a 200 code
     """
-    # Use a requests session with retry logic because the server at
-    # SRTM_URL sometimes returns 503 responses when overloaded
-    session = _requests_retry_session()
-    r = session.get(from_url, stream=True, verify=False)
-    if not r.ok:
-        raise ConnectionError(
-            "Response code {} received for url {}".format(r.status_code, from_url)
-        )
-    file_size = int(r.headers['content-length'])
-    print("Downloading: {} Bytes: {}".format(to_file, file_size),
-          file=sys.stderr)
-
+    r = _get(from_url, to_file)
     with open(to_file, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=8192):
+        for chunk in _counted(r.iter_content(chunk_size=8192)):
             if chunk:  # filter out keep-alive new chunks
                 f.write(chunk)
 
 
-def get_srtm_tile(srtm_tile, out_dir):
+class UnstreamableZipError(ValueError):
+    """The zip archive cannot be extracted while it is being read."""
+
+
+def extract_zip_stream(chunks, member, dst):
+    """
+    Extract a member of a zip archive that is read sequentially, e.g. while
+    it is being downloaded, without storing the archive.
+
+    Args:
+        chunks: iterable of bytes, the content of the archive
+        member: name of the file to extract
+        dst: binary file object where the member is written
+
+    Returns:
+        bool: True if the member was extracted, False if the content is not a
+        zip archive or if the archive has no such member
+
+    Raises:
+        UnstreamableZipError: if the archive cannot be read sequentially
+            (encrypted, zip64, unknown compression)
+        ValueError: if the archive is truncated or corrupted
+    """
+    chunks = iter(chunks)
+    buf = bytearray()
+
+    def fill(n):
+        while len(buf) < n:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            buf.extend(chunk)
+        return True
+
+    def truncated():
+        return ValueError("truncated zip archive")
+
+    while fill(4) and buf[:4] == b'PK\x03\x04':  # local file header
+        if not fill(30):
+            raise truncated()
+        (flags, method, crc, csize, name_len,
+         extra_len) = struct.unpack('<6xHH4xIIxxxxHH', bytes(buf[:30]))
+        if not fill(30 + name_len + extra_len):
+            raise truncated()
+        name = bytes(buf[30:30 + name_len]).decode(
+            'utf-8' if flags & 0x800 else 'cp437')
+        del buf[:30 + name_len + extra_len]
+
+        has_descriptor = flags & 0x08
+        if flags & 0x01 or method not in (0, 8) or csize == 0xffffffff or \
+                (method == 0 and has_descriptor):
+            raise UnstreamableZipError(name)
+
+        out = dst if name == member else None
+        crc_out = 0
+        if method == 8:  # deflate
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            while not decompressor.eof:
+                if not buf and not fill(1):
+                    raise truncated()
+                data = decompressor.decompress(bytes(buf))
+                buf[:] = decompressor.unused_data
+                if out is not None:
+                    out.write(data)
+                    crc_out = zlib.crc32(data, crc_out)
+        else:  # stored
+            remaining = csize
+            while remaining:
+                if not buf and not fill(1):
+                    raise truncated()
+                data = bytes(buf[:remaining])
+                del buf[:len(data)]
+                remaining -= len(data)
+                if out is not None:
+                    out.write(data)
+                    crc_out = zlib.crc32(data, crc_out)
+
+        if has_descriptor:
+            if not fill(16):
+                raise truncated()
+            offset = 4 if buf[:4] == b'PK\x07\x08' else 0
+            crc, = struct.unpack('<I', bytes(buf[offset:offset + 4]))
+            del buf[:offset + 12]
+
+        if out is not None:
+            if crc_out & 0xffffffff != crc:
+                raise ValueError("bad CRC-32 for {}".format(name))
+            return True
+
+    return False
+
+
+def retile(tif_path, block_size=256):
+    """
+    Re-encode an srtm tile as an internally tiled, deflate compressed GeoTIFF
+    file, with the profile of the crops (see srtm4.raster.write_crop_to_file).
+
+    The CGIAR tif files are striped: each windowed read decodes whole rows of
+    the tile. In the tiled file, small crops and lookups only decode the
+    blocks they touch. The georeferencing, nodata value, tags and samples
+    are kept, and the file is replaced atomically. This needs rasterio.
+
+    Args:
+        tif_path: path of the tif file of the tile
+        block_size (int): size of the square blocks, a multiple of 16,
+            optional. The default is 256.
+
+    Returns:
+        bool: False if the file was already tiled with this block size
+    """
+    import rasterio
+    from srtm4.raster import _crop_profile
+
+    tmp = '{}.{}.tiled'.format(tif_path, os.getpid())
+    with rasterio.open(tif_path) as src:
+        if src.profile.get('tiled') and src.block_shapes[0] == (block_size,
+                                                                 block_size):
+            return False
+        profile = src.profile
+        profile.update(_crop_profile(src.width, src.height, src.dtypes[0],
+                                     src.transform, src.crs, block_size))
+        try:
+            with rasterio.open(tmp, 'w', **profile) as dst:
+                dst.update_tags(**src.tags())
+                for row in range(0, src.height, block_size):
+                    window = rasterio.windows.Window(
+                        0, row, src.width, min(block_size, src.height - row))
+                    dst.write(src.read(1, window=window), 1, window=window)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    os.replace(tmp, tif_path)
+    return True
+
+
+def get_srtm_tile(srtm_tile, out_dir, base_url=None, tiled=None):
     """
     Download and unzip an srtm tile from the internet.
 
+    Concurrent calls, from threads or processes sharing out_dir, are
+    serialized per tile with a srtm_XX_YY.lock file. The tif file is
+    extracted under a temporary name and renamed into place, so a tif
+    file present in out_dir is always complete and is read without lock.
+
     Args:
         srtm_tile: string following the pattern 'srtm_%02d_%02d', identifying
             the desired strm tile
         out_dir: directory where to store and extract the srtm tiles
+        base_url: url of the directory holding the srtm_XX_YY.zip archives,
+            optional. The default is given by srtm_url.
+        tiled (bool): re-encode the downloaded tile as a tiled GeoTIFF file,
+            see retile, optional. The default is given by tiled_enabled.
     """
     output_dir = os.path.abspath(os.path.expanduser(out_dir))
     try:
@@ -89,57 +338,208 @@ def get_srtm_tile(srtm_tile, out_dir):
     except OSError:
         pass
 
-    srtm_zip_download_lock = os.path.join(output_dir, 'srtm_zip.lock')
-    srtm_tif_write_lock = os.path.join(output_dir, 'srtm_tif.lock')
-
-    if os.path.exists(os.path.join(output_dir, '{}.tif'.format(srtm_tile))):
-        # the tif file is either being written or finished writing
-        # locking will ensure it is not being written.
-        # Also by construction we won't write on something complete.
-        if os.path.exists(srtm_tif_write_lock):
-            lock_tif = filelock.FileLock(srtm_tif_write_lock)
-            lock_tif.acquire()
-            lock_tif.release()
+    tif_name = '{}.tif'.format(srtm_tile)
+    tif_path = os.path.join(output_dir, tif_name)
+    if os.path.exists(tif_path):
         return
 
-    # download the zip file
-    srtm_tile_url = '{}/{}.zip'.format(SRTM_URL, srtm_tile)
-    zip_path = os.path.join(output_dir, '{}.zip'.format(srtm_tile))
+    with filelock.FileLock(os.path.join(output_dir,
+                                        '{}.lock'.format(srtm_tile))):
+        if os.path.exists(tif_path):
+            # another process downloaded the tile while we were waiting
+            return
 
-    lock_zip = filelock.FileLock(srtm_zip_download_lock)
-    lock_zip.acquire()
+        # extract the tif file while the zip file is being downloaded, and
+        # publish it atomically
+        srtm_tile_url = '{}/{}.zip'.format((base_url or srtm_url()).rstrip('/'),
+                                           srtm_tile)
+        tmp_path = tif_path + '.part'
+        start = time.perf_counter()
+        try:
+            try:
+                r = _get(srtm_tile_url, tif_path)
+                with r, open(tmp_path, 'wb') as dst:
+                    extracted = extract_zip_stream(
+                        _counted(r.iter_content(1 << 20)), tif_name, dst)
+            except UnstreamableZipError:
+                extracted = _download_and_extract(srtm_tile_url, output_dir,
+                                                  tif_name, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            metrics.add('download_seconds', time.perf_counter() - start)
 
-    if os.path.exists(os.path.join(output_dir, '{}.tif'.format(srtm_tile))):
-        # since the zip lock is returned after the tif lock
-        # if we end up here, it means another process downloaded the zip
-        # and extracted it.
-        # No need to wait on lock_tif
-        lock_zip.release()
-        return
+        if extracted:
+            if tiled if tiled is not None else tiled_enabled():
+                try:
+                    retile(tmp_path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            os.replace(tmp_path, tif_path)
+            metrics.add('tiles_downloaded')
+        else:
+            os.remove(tmp_path)
+            print('{} not available'.format(srtm_tile))
 
-    if os.path.exists(zip_path):
-        print('zip already exists')
-        # Only possibility here is that the previous process was cut short
 
+def _download_and_extract(url, output_dir, member, to_file):
+    """
+    Download a zip file and extract one of its members, for the archives that
+    cannot be extracted while they are being downloaded.
+
+    Returns:
+        bool: True if the member was extracted
+    """
+    zip_path = os.path.join(output_dir, os.path.basename(url))
     try:
-        download(zip_path, srtm_tile_url)
-    except (ConnectionError, RetryError) as e:
-        lock_zip.release()
-        raise e
-
-    lock_tif = filelock.FileLock(srtm_tif_write_lock)
-    lock_tif.acquire()
-
-    # extract the tif file
-    if zipfile.is_zipfile(zip_path):
-        z = zipfile.ZipFile(zip_path, 'r')
-        z.extract('{}.tif'.format(srtm_tile), output_dir)
-    else:
-        print('{} not available'.format(srtm_tile))
+        download(zip_path, url)
+        if not zipfile.is_zipfile(zip_path):
+            return False
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            if member not in z.namelist():
+                return False
+            with z.open(member) as src, open(to_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        return True
+    finally:
+        # remove the zip file
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+
+def get_srtm_tiles(srtm_tiles, out_dir, max_workers=8, skip_unavailable=False,
+                   base_url=None, tiled=None):
+    """
+    Download and unzip srtm tiles from the internet, in parallel.
+
+    Args:
+        srtm_tiles: list of strings following the pattern 'srtm_%02d_%02d'
+        out_dir: directory where to store and extract the srtm tiles
+        max_workers (int): maximum number of concurrent downloads, optional.
+            The default is 8.
+        skip_unavailable (bool): skip the tiles for which the server does not
+            return a 200 code instead of raising, optional.
+            The default is False.
+        base_url, tiled: see get_srtm_tile
+
+    Returns:
+        list of str: names of the requested tiles present in out_dir
+
+    Raises:
+        ConnectionError: if a tile cannot be downloaded and skip_unavailable
+            is False
+    """
+    output_dir = os.path.abspath(os.path.expanduser(out_dir))
+
+    def present(srtm_tile):
+        return os.path.exists(os.path.join(output_dir,
+                                           '{}.tif'.format(srtm_tile)))
+
+    def fetch(srtm_tile):
+        try:
+            get_srtm_tile(srtm_tile, out_dir, base_url=base_url, tiled=tiled)
+        except ConnectionError:
+            if not skip_unavailable:
+                raise
+
+    srtm_tiles = list(dict.fromkeys(srtm_tiles))
+    missing = [t for t in srtm_tiles if not present(t)]
+    if len(missing) == 1 or max_workers <= 1:
+        for srtm_tile in missing:
+            fetch(srtm_tile)
+    elif missing:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as pool:
+            # wait for all the downloads before raising the first error
+            futures = [pool.submit(fetch, t) for t in missing]
+            errors = [f.exception() for f in futures]
+        for e in errors:
+            if e is not None:
+                raise e
+
+    return [t for t in srtm_tiles if present(t)]
+
+
+def _sha256(path):
+    """SHA-256 checksum of a file, as a hex string."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(out_dir):
+    """
+    Read the manifest of a directory of srtm tiles.
+
+    Returns:
+        dict giving, for each srtm tile name, a dict with the size in bytes
+        and the SHA-256 checksum of its tif file. It is empty if there is no
+        manifest.
+    """
+    path = os.path.join(os.path.abspath(os.path.expanduser(out_dir)), MANIFEST)
+    try:
+        with open(path) as f:
+            return json.load(f)['tiles']
+    except FileNotFoundError:
+        return {}
+
 
-    # remove the zip file
-    os.remove(zip_path)
+def write_manifest(out_dir, srtm_tiles=None):
+    """
+    Record the sizes and checksums of srtm tiles in the manifest of their
+    directory, manifest.json.
+
+    The other tiles of the manifest are kept if their tif file is still
+    there, so that the manifest can be updated after each download.
+
+    Args:
+        out_dir: directory where the srtm tiles are stored
+        srtm_tiles: list of strings following the pattern 'srtm_%02d_%02d',
+            optional. The default is all the tif files of out_dir.
+
+    Returns:
+        dict of the tiles of the manifest, see read_manifest
+    """
+    output_dir = os.path.abspath(os.path.expanduser(out_dir))
+    if srtm_tiles is None:
+        srtm_tiles = [f[:-4] for f in os.listdir(output_dir)
+                      if f.startswith('srtm_') and f.endswith('.tif')]
 
-    # release locks
-    lock_tif.release()
-    lock_zip.release()
+    with filelock.FileLock(os.path.join(output_dir, MANIFEST + '.lock')):
+        tiles = {name: entry for name, entry in read_manifest(output_dir).items()
+                 if os.path.exists(os.path.join(output_dir, name + '.tif'))}
+        for name in srtm_tiles:
+            tif_path = os.path.join(output_dir, name + '.tif')
+            if os.path.exists(tif_path):
+                tiles[name] = {'size': os.path.getsize(tif_path),
+                               'sha256': _sha256(tif_path)}
+
+        path = os.path.join(output_dir, MANIFEST)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'tiles': dict(sorted(tiles.items()))}, f, indent=1)
+        os.replace(tmp, path)
+    return tiles
+
+
+def check_manifest(out_dir):
+    """
+    Check the tif files of a directory of srtm tiles against its manifest.
+
+    Returns:
+        list of str: names of the tiles of the manifest whose tif file is
+        missing, or has another size or checksum
+    """
+    output_dir = os.path.abspath(os.path.expanduser(out_dir))
+    bad = []
+    for name, entry in sorted(read_manifest(output_dir).items()):
+        tif_path = os.path.join(output_dir, name + '.tif')
+        if not os.path.exists(tif_path) \
+                or os.path.getsize(tif_path) != entry['size'] \
+                or _sha256(tif_path) != entry['sha256']:
+            bad.append(name)
+    return bad
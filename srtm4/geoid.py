@@ -0,0 +1,253 @@
+"""
+Heights of the EGM96 geoid above the WGS84 ellipsoid.
+
+The geoid grid data/egm96-15.pgm is read once per process and kept in memory.
+It is evaluated by the srtm4 library when it is available, and otherwise by a
+numpy port of the cubic interpolation of GeographicLib::Geoid.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from srtm4 import _native
+
+GEOID = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# GeographicLib::Geoid cubic fit with a 12-point stencil: common denominators
+# and transfer matrices (stencil x terms) in the interior and at the N/S rows
+_C0 = 240
+_C3 = np.array([
+    [9, -18, -88, 0, 96, 90, 0, 0, -60, -20],
+    [-9, 18, 8, 0, -96, 30, 0, 0, 60, -20],
+    [9, -88, -18, 90, 96, 0, -20, -60, 0, 0],
+    [186, -42, -42, -150, -96, -150, 60, 60, 60, 60],
+    [54, 162, -78, 30, -24, -90, -60, 60, -60, 60],
+    [-9, -32, 18, 30, 24, 0, 20, -60, 0, 0],
+    [-9, 8, 18, 30, -96, 0, -20, 60, 0, 0],
+    [54, -78, 162, -90, -24, 30, 60, -60, 60, -60],
+    [-54, 78, 78, 90, 144, 90, -60, -60, -60, -60],
+    [9, -8, -18, -30, -24, 0, 20, 60, 0, 0],
+    [-9, 18, -32, 0, 24, 30, 0, 0, -60, 20],
+    [9, -18, -8, 0, -24, -30, 0, 0, 60, 20],
+], dtype=np.float64)
+_C0N = 372
+_C3N = np.array([
+    [0, 0, -131, 0, 138, 144, 0, 0, -102, -31],
+    [0, 0, 7, 0, -138, 42, 0, 0, 102, -31],
+    [62, 0, -31, 0, 0, -62, 0, 0, 0, 31],
+    [124, 0, -62, 0, 0, -124, 0, 0, 0, 62],
+    [124, 0, -62, 0, 0, -124, 0, 0, 0, 62],
+    [62, 0, -31, 0, 0, -62, 0, 0, 0, 31],
+    [0, 0, 45, 0, -183, -9, 0, 93, 18, 0],
+    [0, 0, 216, 0, 33, 87, 0, -93, 12, -93],
+    [0, 0, 156, 0, 153, 99, 0, -93, -12, -93],
+    [0, 0, -45, 0, -3, 9, 0, 93, -18, 0],
+    [0, 0, -55, 0, 48, 42, 0, 0, -84, 31],
+    [0, 0, -7, 0, -48, -42, 0, 0, 84, 31],
+], dtype=np.float64)
+_C0S = 372
+_C3S = np.array([
+    [18, -36, -122, 0, 120, 135, 0, 0, -84, -31],
+    [-18, 36, -2, 0, -120, 51, 0, 0, 84, -31],
+    [36, -165, -27, 93, 147, -9, 0, -93, 18, 0],
+    [210, 45, -111, -93, -57, -192, 0, 93, 12, 93],
+    [162, 141, -75, -93, -129, -180, 0, 93, -12, 93],
+    [-36, -21, 27, 93, 39, 9, 0, -93, -18, 0],
+    [0, 0, 62, 0, 0, 31, 0, 0, 0, -31],
+    [0, 0, 124, 0, 0, 62, 0, 0, 0, -62],
+    [0, 0, 124, 0, 0, 62, 0, 0, 0, -62],
+    [0, 0, 62, 0, 0, 31, 0, 0, 0, -31],
+    [-18, 36, -64, 0, 66, 51, 0, 0, -102, 31],
+    [18, -36, 2, 0, -66, -51, 0, 0, 102, 31],
+], dtype=np.float64)
+
+# (column, row) offsets of the stencil points w.r.t. the cell corner
+_STENCIL = np.array([(0, -1), (1, -1),
+                     (-1, 0), (0, 0), (1, 0), (2, 0),
+                     (-1, 1), (0, 1), (1, 1), (2, 1),
+                     (0, 2), (1, 2)])
+
+# maximal number of samples of the blocks filled at once by geoid_height_grid
+GRID_BLOCK_SIZE = 1 << 20
+
+
+@lru_cache(maxsize=None)
+def egm96_grid(geoid_dir=GEOID):
+    """
+    Read the EGM96 15' grid of GeographicLib.
+
+    Args:
+        geoid_dir: directory containing egm96-15.pgm
+
+    Returns:
+        raw: (721, 1440) float64 array of raw values, rows from 90N to 90S and
+            columns from 0E eastwards, with heights = offset + scale * raw
+        offset, scale: floats
+    """
+    path = os.path.join(geoid_dir, 'egm96-15.pgm')
+    offset = scale = None
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'P5':
+            raise ValueError("File not in PGM format {}".format(path))
+        while True:
+            line = f.readline()
+            if line.startswith(b'#'):
+                words = line.split()
+                if len(words) == 3 and words[1] == b'Offset':
+                    offset = float(words[2])
+                elif len(words) == 3 and words[1] == b'Scale':
+                    scale = float(words[2])
+            elif line.strip():
+                width, height = (int(x) for x in line.split())
+                break
+        f.readline()  # maxval
+        raw = np.fromfile(f, dtype='>u2', count=width * height)
+    return raw.reshape(height, width).astype(np.float64), offset, scale
+
+
+@lru_cache(maxsize=None)
+def _padded_grid(geoid_dir=GEOID):
+    """
+    EGM96 grid extended by one row beyond each pole and by one column west and
+    two columns east, so that the cubic stencil never leaves the array.
+    """
+    raw, offset, scale = egm96_grid(geoid_dir)
+    height, width = raw.shape
+    # beyond the poles, continue on the opposite meridian
+    north = np.roll(raw[1], width // 2)
+    south = np.roll(raw[height - 2], width // 2)
+    padded = np.vstack([north, raw, south])
+    padded = np.hstack([padded[:, -1:], padded, padded[:, :2]])
+    return padded, offset, scale
+
+
+def _geoid_height_numpy(lons, lats, geoid_dir=GEOID):
+    """
+    Evaluate the geoid with the cubic interpolation of GeographicLib::Geoid.
+
+    Args:
+        lons, lats: flat float64 arrays
+
+    Returns:
+        float64 array of geoid heights
+    """
+    padded, offset, scale = _padded_grid(geoid_dir)
+    height = padded.shape[0] - 2
+    width = padded.shape[1] - 3
+    rlonres = width / 360
+    rlatres = (height - 1) / 180
+
+    lons = (lons + 180) % 360 - 180
+    fx = lons * rlonres
+    fy = -lats * rlatres
+    ix = np.floor(fx)
+    iy = np.minimum((height - 1) // 2 - 1, np.floor(fy))
+    fx = fx - ix
+    fy = fy - iy
+    ix = ix + np.where(ix < 0, width, 0)
+    iy = iy + (height - 1) // 2
+
+    invalid = ~(np.isfinite(fx) & np.isfinite(fy))
+    ix = np.where(invalid, 0, ix).astype(np.intp)
+    iy = np.where(invalid, 0, iy).astype(np.intp)
+
+    # gather the 12 stencil values, in the padded grid coordinates
+    v = padded[iy[:, None] + 1 + _STENCIL[:, 1], ix[:, None] + 1 + _STENCIL[:, 0]]
+    t = v @ (_C3 / _C0)
+    north = iy == 0
+    south = iy == height - 2
+    if north.any():
+        t[north] = v[north] @ (_C3N / _C0N)
+    if south.any():
+        t[south] = v[south] @ (_C3S / _C0S)
+
+    h = (t[:, 0] + fx * (t[:, 1] + fx * (t[:, 3] + fx * t[:, 6])) +
+         fy * (t[:, 2] + fx * (t[:, 4] + fx * t[:, 7]) +
+               fy * (t[:, 5] + fx * t[:, 8] + fy * t[:, 9])))
+    h = offset + scale * h
+    h[invalid] = np.nan
+    return h
+
+
+def geoid_height_grid(lon_axis, lat_axis, dtype=np.float64, block_rows=256):
+    """
+    Gives the height of the EGM96 geoid on a regular grid of points.
+
+    The 15' grid is interpolated bilinearly, as PROJ does with the
+    us_nga_egm96_15 grid, and separably: the rows of the grid surrounding each
+    block of rows of the result are first interpolated at the longitudes, and
+    then combined at each latitude. The blocks hold at most GRID_BLOCK_SIZE
+    samples, so that the memory needed beyond the result is proportional to
+    its width.
+
+    Args:
+        lon_axis, lat_axis: 1D arrays of longitudes and latitudes of the
+            columns and rows of the grid
+        dtype: type of the result, optional. The default is float64.
+        block_rows (int): maximal number of rows filled at once, optional.
+
+    Returns:
+        (len(lat_axis), len(lon_axis)) array of geoid heights in meters above
+        the WGS84 ellipsoid
+    """
+    raw, offset, scale = egm96_grid()
+    height, width = raw.shape
+    lon_axis = np.asarray(lon_axis, dtype=np.float64)
+    lat_axis = np.asarray(lat_axis, dtype=np.float64)
+
+    # columns of the grid, from 0E eastwards, and rows, from 90N southwards
+    fx = np.mod(lon_axis, 360) * (width / 360)
+    ix = np.floor(fx).astype(np.intp)
+    wx = fx - ix
+    ix %= width
+    ix1 = (ix + 1) % width
+    fy = (90 - np.clip(lat_axis, -90, 90)) * ((height - 1) / 180)
+    iy = np.minimum(np.floor(fy).astype(np.intp), height - 2)
+    wy = (fy - iy)[:, None]
+    block_rows = max(1, min(block_rows, GRID_BLOCK_SIZE // max(lon_axis.size, 1)))
+
+    out = np.empty((lat_axis.size, lon_axis.size), dtype=dtype)
+    for start in range(0, lat_axis.size, block_rows):
+        block = slice(start, start + block_rows)
+        # interpolate the rows of the grid used by the block at the longitudes
+        needed = np.union1d(iy[block], iy[block] + 1)
+        rows = raw[needed]
+        rows = offset + scale * (rows[:, ix] * (1 - wx) + rows[:, ix1] * wx)
+        i = np.searchsorted(needed, iy[block])
+        out[block] = rows[i] * (1 - wy[block]) + rows[i + 1] * wy[block]
+    return out
+
+
+def geoid_height(lon, lat, out=None):
+    """
+    Gives the height of the EGM96 geoid at a (list of) point(s).
+
+    Args:
+        lon, lat: lists or arrays of longitudes and latitudes (same length),
+            or single longitude and latitude
+        out (optional): C-contiguous float64 ndarray with one element per
+            point, filled in place with the heights
+
+    Returns:
+        geoid height(s) in meters above the WGS84 ellipsoid, as a float for a
+        single point and as an ndarray (out, if given) otherwise
+    """
+    lib = _native.load()
+    lons = _native.as_f64(lon)
+    lats = _native.as_f64(lat)
+    if out is not None:
+        heights = _native.check_out(out, lons.size)
+    else:
+        heights = np.empty(lons.size, dtype=np.float64)
+
+    if lib is not None:
+        _native.geoid_heights(lib, lons, lats, heights, GEOID)
+    else:
+        heights[:] = _geoid_height_numpy(lons, lats)
+
+    if out is not None:
+        return out
+    if np.ndim(lon) == 0:
+        return float(heights[0])
+    return heights.reshape(np.shape(lon))
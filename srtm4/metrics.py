@@ -0,0 +1,116 @@
+"""
+Counters and timers of the work done by srtm4 in the process.
+
+The queries, tile reads, downloads and crops add to process-wide counters,
+read with stats. Each update takes a lock and a dict update, once per call
+and never per point, so the instrumentation is always on. A callback can be
+registered to forward each update to a metrics pipeline.
+"""
+import contextlib
+import threading
+import time
+
+from srtm4 import _native
+
+_lock = threading.Lock()
+_counters = {}
+_callback = None
+
+
+def add(name, value=1):
+    """
+    Add value to a counter, and pass the update to the callback, if any.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    callback = _callback
+    if callback is not None:
+        callback(name, value)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Add the wall-clock seconds spent in the block to the counter name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start)
+
+
+def set_stats_callback(callback):
+    """
+    Register a function called at each update of a counter.
+
+    Args:
+        callback: function called as callback(name, value), with the name
+            of the counter and the value added to it (a count, a number of
+            bytes, or seconds for the names ending with _seconds), from the
+            thread doing the work, or None to unregister it
+    """
+    global _callback
+    _callback = callback
+
+
+def reset_stats():
+    """
+    Reset the counters, including those of the tile cache of the library.
+    """
+    with _lock:
+        _counters.clear()
+    lib = _native.load()
+    if lib is not None:
+        lib.srtm4_reset_tile_cache_stats()
+        lib.geoid_evaluations(1)
+
+
+def stats(reset=False):
+    """
+    Counters and timers of the work done by srtm4 in the process.
+
+    Args:
+        reset (bool): reset them after reading them, optional.
+            The default is False.
+
+    Returns:
+        dict with, among others, when the corresponding work was done:
+            points, query_seconds, points_per_s: points evaluated by srtm4
+                and srtm4_grid, time spent in these calls and their ratio
+            subprocess_seconds: time spent running the srtm4 binary
+            geoid_seconds: time spent adding the geoid heights in Python
+                (the native engine adds them in the library, and only
+                counts them in geoid_points)
+            geoid_points: geoid heights evaluated by the srtm4 library, for
+                the native engine, the server and geoid_height
+            tiles_read: tiles read by the numpy code (sidecars mapped or
+                tif files decoded)
+            tiles_decoded, tile_decode_seconds: tif files decoded by the
+                numpy code, and time spent doing it
+            tiles_downloaded, bytes_downloaded, download_seconds: tiles
+                downloaded, bytes received and time spent downloading
+            crops, crop_seconds, pixels: crops computed by crop and
+                crop_to_file, time spent and number of pixels
+            merge_seconds, datum_shift_seconds: time spent merging the tiles
+                and adding the geoid heights in the crops
+            tile_cache_hits, tile_cache_misses, tile_cache_evictions,
+            tile_cache_tiles, tile_cache_bytes, tile_cache_blocks: counters
+                of the tile cache of the srtm4 library, used by the native
+                engine, see srtm4.tile_cache_stats. The library decodes the
+                tiles lazily, by blocks of rows, without timing them
+    """
+    with _lock:
+        out = dict(_counters)
+    if out.get('query_seconds'):
+        out['points_per_s'] = out.get('points', 0) / out['query_seconds']
+    lib = _native.load()
+    if lib is not None:
+        cache = _native.tile_cache_stats(lib)
+        for name in ('hits', 'misses', 'evictions', 'tiles', 'bytes',
+                     'blocks'):
+            out['tile_cache_' + name] = cache[name]
+        out['geoid_points'] = lib.geoid_evaluations(0)
+    if reset:
+        reset_stats()
+    return out
@@ -5,19 +5,20 @@ The AREA_OR_POINT tag is wrong in the geotiff meta.
 In this code, we do not touch the tag, but only correct the effect by taking into
 account that the transform's origin is the center of the first pixel.
 """
+import atexit
+import contextlib
 import os
+import threading
+import time
+import warnings
 import numpy as np
 
 import affine
-import pyproj
-
-# network access to datum grids
-pyproj.network.set_network_enabled(active=True)
-
 import rasterio
 
-from srtm4.download import get_srtm_tile
-from srtm4.point import srtm4_which_tile, SRTM_DIR
+from srtm4 import metrics
+from srtm4.geoid import geoid_height_grid
+from srtm4.point import prefetch, srtm4_which_tiles, SRTM_DIR
 
 try:
     from functools import cache
@@ -29,6 +30,84 @@ TILE_SIZE = 6000
 # degree resolution
 RES = 3 / 3600
 
+
+class DatasetPool:
+    """
+    Pool of open rasterio datasets, shared by the crops.
+
+    Each dataset is leased to one caller at a time, as rasterio datasets
+    cannot be read from several threads at once. The released datasets stay
+    open for later leases, and the least recently used ones are closed
+    beyond max_size.
+
+    Args:
+        max_size (int): maximum number of open datasets that are not leased
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._idle = []  # (path, dataset), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, path):
+        """Lease an open dataset of a raster file."""
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == path:
+                    return self._idle.pop(i)[1]
+        return rasterio.open(path, 'r')
+
+    def release(self, path, dataset):
+        """Give back a leased dataset, and close the extra ones."""
+        with self._lock:
+            self._idle.append((path, dataset))
+            evicted = self._idle[:max(len(self._idle) - self.max_size, 0)]
+            del self._idle[:len(evicted)]
+        for _, d in evicted:
+            d.close()
+
+    @contextlib.contextmanager
+    def lease(self, paths):
+        """
+        Lease the datasets of a list of raster files.
+
+        Args:
+            paths: list of paths, or of already opened datasets that are
+                passed through
+
+        Yields:
+            list of opened datasets
+        """
+        leased = []
+        try:
+            datasets = []
+            for path in paths:
+                if isinstance(path, (str, os.PathLike)):
+                    dataset = self.acquire(path)
+                    leased.append((path, dataset))
+                    datasets.append(dataset)
+                else:
+                    datasets.append(path)
+            yield datasets
+        finally:
+            for path, dataset in leased:
+                self.release(path, dataset)
+
+    def close(self):
+        """Close all the datasets that are not leased."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, d in idle:
+            d.close()
+
+
+# open tiles, bounded by the SRTM4_MAX_OPEN_TILES environment variable
+DATASETS = DatasetPool(int(os.getenv('SRTM4_MAX_OPEN_TILES', 16)))
+atexit.register(DATASETS.close)
+
 def name2id(tile_name):
     """
     Convert the tile name to the lon, lat ids.
@@ -95,12 +174,35 @@ def intersect_intervals(interval_one, interval_two):
         return (low_inter, up_inter)
 
 
-def adjust_bounds_to_px_grid(bounds):
+def resolution_factor(resolution):
+    """
+    Get the size, in SRTM90 pixels, of the pixels of a crop at a resolution.
+
+    The size is a divisor of TILE_SIZE, so that the pixels of the crop,
+    aligned on the tiles, never straddle two tiles.
+
+    Args:
+        resolution: float, size of the pixels of the crop in degrees, or None
+                    for the SRTM90 resolution RES
+
+    Returns:
+        factor: int, the resolution of the crop is factor * RES
+    """
+    if resolution is None:
+        return 1
+    divisors = [d for d in range(1, TILE_SIZE + 1) if TILE_SIZE % d == 0]
+    return min(divisors, key=lambda d: abs(np.log(d * RES / resolution)))
+
+
+def adjust_bounds_to_px_grid(bounds, factor=1):
     """
     Adjust the bounds to fall exactly onto the pixel grid (center of pixels) of SRTM90.
 
     Args: 
         bounds: tuple (lon_min, lat_min, lon_max, lat_max) 
+        factor: int, size of the pixels of the output image in SRTM90 pixels,
+                a divisor of TILE_SIZE, optional. Each output pixel covers
+                factor x factor pixels of a single tile. The default is 1.
 
     Returns: 
         adjusted_bounds: tuple (lon_min, lat_min, lon_max, lat_max) 
@@ -111,21 +213,25 @@ def adjust_bounds_to_px_grid(bounds):
 
     """
     lon_min, lat_min, lon_max, lat_max = bounds
-
-    # Adjust to pixel grid
-    col_min = int(np.floor(lon_min / RES))
-    col_max = int(np.ceil(lon_max / RES))
-    row_min = int(np.floor(lat_min / RES))
-    row_max = int(np.ceil(lat_max / RES))
-
-    lon_min = RES * col_min
-    lon_max = RES * col_max
-    lat_min = RES * row_min
-    lat_max = RES * row_max
+    f = factor
+
+    # Adjust to pixel grid. The output pixel (col, row) covers the SRTM90
+    # pixels of centers lon / RES in [f * col, f * col + f - 1] and
+    # lat / RES in [f * row - f + 1, f * row]
+    col_min = int(np.floor(lon_min / RES / f))
+    col_max = int(np.ceil((lon_max / RES - f + 1) / f))
+    row_min = int(np.floor((lat_min / RES + f - 1) / f))
+    row_max = int(np.ceil(lat_max / RES / f))
+
+    lon_min = RES * f * col_min + RES * (f - 1) / 2
+    lon_max = RES * f * col_max + RES * (f - 1) / 2
+    lat_min = RES * f * row_min - RES * (f - 1) / 2
+    lat_max = RES * f * row_max - RES * (f - 1) / 2
     
     adjusted_bounds = (lon_min, lat_min, lon_max, lat_max)
     # Translate by half a pixel for the px_is_area transform( upper left corner)
-    transform = affine.Affine(RES, 0, lon_min - RES/2, 0, -RES, lat_max + RES/2)
+    res = f * RES
+    transform = affine.Affine(res, 0, lon_min - res/2, 0, -res, lat_max + res/2)
     shape =  (row_max - row_min + 1, col_max - col_min + 1)
     
     return adjusted_bounds, transform, shape
@@ -133,6 +239,11 @@ def adjust_bounds_to_px_grid(bounds):
 
 @cache
 def _get_ellipsoid_geoid_transformer():
+    import pyproj
+
+    # network access to datum grids
+    pyproj.network.set_network_enabled(active=True)
+
     # WGS84 with ellipsoid height as vertical axis
     ellipsoid = pyproj.CRS.from_epsg(4979)
 
@@ -144,7 +255,8 @@ def _get_ellipsoid_geoid_transformer():
 
 def to_ellipsoid(lons, lats, alts):
     """
-    Convert geoidal heights to ellipsoidal heights.
+    Convert geoidal heights to ellipsoidal heights with pyproj, which may
+    download the us_nga_egm96_15 grid. crop uses geoid_height_grid instead.
 
     Args:
         lats, lons (array): 1D arrays of latitudes and longitudes
@@ -238,7 +350,8 @@ def merge(datasets, transform, shape, nodata=np.nan, dtype="f4"):
     Merge multiple rasterio datasets into a final array.
 
     Args:
-        datasets: list of opened rasterio datasets.
+        datasets: list of opened rasterio datasets, or of paths of raster
+                  files, which are opened through the DATASETS pool.
         transform: affine.Affine transform of the final image in px_is_area convention.
         shape: tuple (height, width) shape of the final image. 
         nodata: nodata value in the final array, optional.
@@ -262,71 +375,67 @@ def merge(datasets, transform, shape, nodata=np.nan, dtype="f4"):
         mask = np.logical_and(old_nodata, ~new_nodata)
         old_data[mask] = new_data[mask]
 
-    for dataset in datasets:
-        # compute intersection
-        int_bounds = intersect_bounds(dst_bounds, dataset.bounds)
+    with DATASETS.lease(datasets) as datasets:
+        for dataset in datasets:
+            # compute intersection
+            int_bounds = intersect_bounds(dst_bounds, dataset.bounds)
 
-        w, s, e, n = int_bounds
-        if w is None:  # empty intersection, skip
-            continue
+            w, s, e, n = int_bounds
+            if w is None:  # empty intersection, skip
+                continue
 
-        # compute dest window in dst_array
+            # compute dest window in dst_array
 
-        col_dst, row_dst, width_dst, height_dst = get_px_region(
-            int_bounds, transform)
-        col, row, width, height = get_px_region(int_bounds, dataset.transform,
-                                                transform_is_area=False)
+            col_dst, row_dst, width_dst, height_dst = get_px_region(
+                int_bounds, transform)
+            col, row, width, height = get_px_region(int_bounds, dataset.transform,
+                                                    transform_is_area=False)
 
-        # read source
-        tmp_array = dataset.read(1,
-                                 window=((row, row + height),
-                                         (col, col + width))
-                                 )
+            # read source
+            tmp_array = dataset.read(1,
+                                     window=((row, row + height),
+                                             (col, col + width))
+                                     )
 
-        # write tmp_array into dst_region
-        dst_region = dst_array[row_dst: row_dst +
-                               height_dst, col_dst: col_dst + width_dst]
-        mask_region = np.isnan(dst_region) if np.isnan(
-            nodata) else dst_region == nodata
-        mask_tmp = np.isnan(tmp_array) if np.isnan(
-            dataset.nodata) else tmp_array == dataset.nodata
+            # write tmp_array into dst_region
+            dst_region = dst_array[row_dst: row_dst +
+                                   height_dst, col_dst: col_dst + width_dst]
+            mask_region = np.isnan(dst_region) if np.isnan(
+                nodata) else dst_region == nodata
+            mask_tmp = np.isnan(tmp_array) if np.isnan(
+                dataset.nodata) else tmp_array == dataset.nodata
 
-        copyto(dst_region, tmp_array.astype(dtype), mask_region, mask_tmp)
+            copyto(dst_region, tmp_array.astype(dtype), mask_region, mask_tmp)
 
     return dst_array
 
 
-def crop_at_continous_lon_limits(bounds, datum="ellipsoidal"):
+def _crop_grid(bounds, factor=1):
     """
-    Computes a crop of SRTM90 from the specified bounds.
+    Get the pixel grid of a crop, and the tiles that it needs.
     It is assumed that the bounds do not cross the antimeridian.
 
-    Args: 
+    Args:
         bounds: geospatial bound tuple (lon_min, lat_min, lon_max, lat_max).
-        datum: str, either "ellipsoidal" or "orthometric". SRTM90 tiles are 
-            by default orthometric (w.r.t. the egm96_15 geoid). If "orthometric"
-            is selected, the tiles are simply stitched together. When "ellipsoidal"
-            is selected, a datum shift will also be applied and the height will be 
-            referenced to the ellipsoid.
+        factor: int, size of the pixels of the crop in SRTM90 pixels, see
+            resolution_factor. The default is 1.
+
     Returns:
-        raster: np.2darray of the dem crop
-        transform: affine.Affine transform in px_is_area convention
-        crs: rasterio.crs.CRS. always epsg:4326, even if orthometric (2D crs)
-        
+        tuple (bounds, transform, shape, tile_paths) with the bounds adjusted
+        on the pixel grid, the affine.Affine transform in px_is_area
+        convention, the (height, width) shape of the crop and the paths of
+        the tiles, downloaded if needed. None if the bounds are out of
+        coverage.
     """
-    assert datum in [
-        "ellipsoidal", "orthometric"], "Datum must be either ellipsoidal or orthometric"
-
     lon_min, lat_min, lon_max, lat_max = bounds
 
     lat_min, lat_max = intersect_intervals((lat_min, lat_max), (-60, 60))
 
     if lat_min is None:
-        print("Lat coordinates out of coverage, crop will be skipped")
-        return None, None, None
+        return None
 
     bounds, transform, dem_shape = adjust_bounds_to_px_grid(
-        (lon_min, lat_min, lon_max, lat_max))
+        (lon_min, lat_min, lon_max, lat_max), factor)
 
     lon_min, lat_min, lon_max, lat_max = bounds
 
@@ -335,12 +444,11 @@ def crop_at_continous_lon_limits(bounds, datum="ellipsoidal"):
     lats = [lat_max, lat_min]
 
     # get tile ids for bounding pts
-    tiles = srtm4_which_tile(lons, lats)
-    parsed_tiles = [name2id(t) for t in tiles]
+    tiles, index = srtm4_which_tiles(lons, lats)
 
     # all intermediate tile ids
-    lon_ids = [t[0] for t in parsed_tiles]
-    lat_ids = [t[1] for t in parsed_tiles]
+    lon_ids = tiles[index, 0]
+    lat_ids = tiles[index, 1]
 
     # the way the tiles are id'ed, they should be ordered already
 
@@ -350,43 +458,230 @@ def crop_at_continous_lon_limits(bounds, datum="ellipsoidal"):
     assert lat_ids[0] <= lat_ids[1]
     lat_id = np.arange(lat_ids[0], lat_ids[1] + 1)
 
-    datasets = []
-    for lat in lat_id:
-        for lon in lon_id:
-            try:
-                # download tile if not already on the disk
-                get_srtm_tile(id2name(lon, lat), SRTM_DIR)
-            except ConnectionError:
-                continue
-            else:
-                # open, read relevant rows and cols
-                tile_name = os.path.join(SRTM_DIR, id2name(lon, lat) + '.tif')
-                db = rasterio.open(tile_name, 'r')
-                datasets.append(db)
-                
-    if len(datasets) == 0:
+    # download the tiles if not already on the disk
+    tile_names = [id2name(lon, lat) for lat in lat_id for lon in lon_id]
+    tile_names = prefetch(tile_names, skip_unavailable=True)
+
+    # the tiles are opened through the DATASETS pool
+    tile_paths = [os.path.join(SRTM_DIR, tile_name + '.tif')
+                  for tile_name in tile_names]
+
+    if len(tile_paths) == 0:
         raise ValueError("No DEM found on bounds")
 
-    raster = merge(datasets, transform=transform, shape=dem_shape)
+    return bounds, transform, dem_shape, tile_paths
+
+
+def _block_tiles(tile_paths, transform, shape):
+    """
+    Keep the tiles that intersect a block, so that each block of a crop
+    leases only its own tiles from the DATASETS pool.
+
+    Args:
+        tile_paths: paths of the srtm_XX_YY.tif tiles
+        transform: affine.Affine transform of the block in px_is_area
+            convention
+        shape: tuple (height, width) shape of the block
+
+    Returns:
+        list of the paths of the tiles intersecting the block
+    """
+    west, north = transform * (0, 0)
+    east, south = transform * (shape[1], shape[0])
+    paths = []
+    for path in tile_paths:
+        lon_id, lat_id = name2id(os.path.basename(path)[:-len('.tif')])
+        tile_west = -180 + 5 * (lon_id - 1)
+        tile_north = 60 - 5 * (lat_id - 1)
+        # the pixels of the tiles are centered on their borders
+        if (tile_west - RES < east and west < tile_west + 5 + RES and
+                tile_north - 5 - RES < north and south < tile_north + RES):
+            paths.append(path)
+    return paths
+
+
+def _crop_block(grid, row, col, shape, datum, resampling="nearest"):
+    """
+    Compute a block of a crop.
+
+    Args:
+        grid: pixel grid of the crop, as given by _crop_grid
+        row, col: position of the upper left pixel of the block in the crop
+        shape: tuple (height, width) shape of the block
+        datum: str, either "ellipsoidal" or "orthometric"
+        resampling: str, see merge_decimated. The default is "nearest".
+
+    Returns:
+        raster: np.2darray of the block
+    """
+    bounds, transform, _, tile_paths = grid
+    lon_min, _, _, lat_max = bounds
+
+    block_transform = transform * affine.Affine.translation(col, row)
+    tile_paths = _block_tiles(tile_paths, block_transform, shape)
+    factor = special_round(transform.a / RES)
+    with metrics.timer('merge_seconds'):
+        if factor == 1:
+            raster = merge(tile_paths, transform=block_transform, shape=shape)
+        else:
+            raster = merge_decimated(tile_paths, block_transform, shape,
+                                     factor, resampling=resampling)
 
     if datum == "ellipsoidal":
-        shape = raster.shape
+        # coordinates of the centers of the columns and rows
+        lon_axis = lon_min + transform.a * np.arange(col, col + shape[1])
+        lat_axis = lat_max + transform.e * np.arange(row, row + shape[0])
+
+        with metrics.timer('datum_shift_seconds'):
+            raster += geoid_height_grid(lon_axis, lat_axis, dtype=raster.dtype)
+    return raster
 
-        # get dem points in crs
-        col, row = np.meshgrid(
-            np.arange(shape[1]), np.arange(shape[0]))
 
-        col = col.ravel() + 0.5
-        row = row.ravel() + 0.5
+def _read_decimated(dataset, window, factor, resampling, max_pixels=2**22):
+    """
+    Read a window of a tile at a lower resolution.
+
+    Args:
+        dataset: opened rasterio dataset of a SRTM90 tile
+        window: rasterio.windows.Window whose sizes are multiples of factor
+        factor: int, size of the output pixels in pixels of the tile
+        resampling: str, "nearest", "average" or "max"
+        max_pixels: int, maximum number of pixels of the tile read at once
+
+    Returns:
+        float32 array of shape (window.height / factor, window.width / factor),
+        with nan where there is no data
+    """
+    height, width = window.height // factor, window.width // factor
+
+    # decimated read, only the rows and columns needed are decoded
+    if resampling == "nearest":
+        data = dataset.read(1, window=window, out_shape=(height, width),
+                            resampling=rasterio.enums.Resampling.nearest)
+        data = data.astype(np.float32)
+        data[data == dataset.nodata] = np.nan
+        return data
+
+    # bands of full resolution rows, reduced by blocks
+    reduce = np.nanmean if resampling == "average" else np.nanmax
+    out = np.empty((height, width), dtype=np.float32)
+    step = max(1, max_pixels // (window.width * factor))
+    for row in range(0, height, step):
+        rows = min(step, height - row)
+        band = dataset.read(1, window=rasterio.windows.Window(
+            window.col_off, window.row_off + row * factor,
+            window.width, rows * factor)).astype(np.float32)
+        band[band == dataset.nodata] = np.nan
+        with warnings.catch_warnings():
+            # blocks without data give nan
+            warnings.simplefilter("ignore", RuntimeWarning)
+            out[row:row + rows] = reduce(
+                band.reshape(rows, factor, width, factor), axis=(1, 3))
+    return out
+
+
+def merge_decimated(datasets, transform, shape, factor, resampling="nearest",
+                    nodata=np.nan, dtype="f4"):
+    """
+    Merge SRTM90 tiles into a final array of lower resolution.
+
+    Each tile is read once, with a decimated read of the window that the
+    final array covers, so that the pixels read and the memory needed scale
+    with the size of the final array.
+
+    Args:
+        datasets: list of opened rasterio datasets of SRTM90 tiles, or of
+                  their paths, which are opened through the DATASETS pool.
+        transform: affine.Affine transform of the final image in px_is_area
+                   convention, as given by adjust_bounds_to_px_grid.
+        shape: tuple (height, width) shape of the final image.
+        factor: int, size of the pixels of the final image in SRTM90 pixels,
+                a divisor of TILE_SIZE.
+        resampling: str, "nearest", "average" or "max", optional.
+                    The default is "nearest".
+        nodata: nodata value in the final array, optional.
+                The default is np.nan.
+        dtype: Type of data in the final array. the default is "f4".
+
+    Returns
+        dst_array: 2D array (image) containing the merged datasets.
+    """
+    assert resampling in ["nearest", "average", "max"], \
+        "Resampling must be either nearest, average or max"
+
+    dst_array = np.full(shape, nodata, dtype=dtype)
+    dst_height, dst_width = shape
+
+    # index, in SRTM90 pixels from (0, 0), of the first pixel covered
+    col0 = special_round(transform.c / RES + 0.5)
+    row0 = special_round(transform.f / RES - 0.5)
+
+    with DATASETS.lease(datasets) as datasets:
+        for dataset in datasets:
+            # the transform's origin is the center of the first pixel
+            tile_col = special_round(dataset.transform.c / RES)
+            tile_row = special_round(dataset.transform.f / RES)
+
+            # SRTM90 pixels of the tile covered by the final image
+            col_off = col0 - tile_col
+            row_off = tile_row - row0
+            col_start = max(col_off, 0)
+            col_stop = min(col_off + dst_width * factor, dataset.width)
+            row_start = max(row_off, 0)
+            row_stop = min(row_off + dst_height * factor, dataset.height)
+            if col_start >= col_stop or row_start >= row_stop:
+                continue
+
+            # each pixel of the tile window falls in one dst pixel
+            window = rasterio.windows.Window(col_start, row_start,
+                                             col_stop - col_start,
+                                             row_stop - row_start)
+            dst_region = dst_array[(row_start - row_off) // factor:
+                                   (row_stop - row_off) // factor,
+                                   (col_start - col_off) // factor:
+                                   (col_stop - col_off) // factor]
+            tmp_array = _read_decimated(dataset, window, factor, resampling)
+
+            mask_region = np.isnan(dst_region) if np.isnan(
+                nodata) else dst_region == nodata
+            mask = np.logical_and(mask_region, ~np.isnan(tmp_array))
+            dst_region[mask] = tmp_array[mask]
 
-        # to earth coordinates
-        lon, lat = transform * (col, row)
-        # reshape
-        lon = lon.reshape(shape)
-        lat = lat.reshape(shape)
+    return dst_array
+
+
+def crop_at_continous_lon_limits(bounds, datum="ellipsoidal", resolution=None,
+                                 resampling="nearest"):
+    """
+    Computes a crop of SRTM90 from the specified bounds.
+    It is assumed that the bounds do not cross the antimeridian.
+
+    Args: 
+        bounds: geospatial bound tuple (lon_min, lat_min, lon_max, lat_max).
+        datum: str, either "ellipsoidal" or "orthometric". SRTM90 tiles are 
+            by default orthometric (w.r.t. the egm96_15 geoid). If "orthometric"
+            is selected, the tiles are simply stitched together. When "ellipsoidal"
+            is selected, a datum shift will also be applied and the height will be 
+            referenced to the ellipsoid.
+        resolution, resampling: see crop.
+    Returns:
+        raster: np.2darray of the dem crop
+        transform: affine.Affine transform in px_is_area convention
+        crs: rasterio.crs.CRS. always epsg:4326, even if orthometric (2D crs)
         
-        raster = to_ellipsoid(lon, lat, raster)
-    
+    """
+    assert datum in [
+        "ellipsoidal", "orthometric"], "Datum must be either ellipsoidal or orthometric"
+
+    grid = _crop_grid(bounds, resolution_factor(resolution))
+
+    if grid is None:
+        print("Lat coordinates out of coverage, crop will be skipped")
+        return None, None, None
+
+    _, transform, dem_shape, _ = grid
+    raster = _crop_block(grid, 0, 0, dem_shape, datum, resampling)
+
     crs = rasterio.crs.CRS.from_epsg(4326)
     return raster, transform, crs
      
@@ -397,7 +692,33 @@ def wrap_lon(lon):
     return (lon + 180) % 360 - 180
 
 
-def crop(bounds, datum="orthometric"):
+def split_at_antimeridian(bounds):
+    """
+    Split bounds that may intersect the antimeridian into bounds that do not.
+
+    Args:
+        bounds: geospatial bound tuple (lon_min, lat_min, lon_max, lat_max).
+
+    Returns:
+        list of one or two bound tuples, from west to east
+    """
+    lon_start, lat_min, lon_end, lat_max = bounds
+    offset = 0.1 * RES
+    assert lon_start <= lon_end, "Not valid lon interval"
+    lon_start = wrap_lon(lon_start)
+    lon_end = wrap_lon(lon_end)
+    # in this case , wrapping has occured on the interval at antimeridian
+    if lon_end < lon_start:
+
+        bounds_start = lon_start, lat_min, 180 - RES - offset, lat_max
+        bounds_end = -180 + offset, lat_min, lon_end, lat_max
+
+        return [bounds_start, bounds_end]
+
+    return [bounds]
+
+
+def crop(bounds, datum="orthometric", resolution=None, resampling="nearest"):
     """
     Get a crop of the SRTM90 dem at the specified bounds.\
         The bounds can intersect the antimeridian.
@@ -411,36 +732,124 @@ def crop(bounds, datum="orthometric"):
             is selected, the tiles are simply stitched together. When "ellipsoidal"
             is selected, a datum shift will also be applied and the height will be 
             referenced to the ellipsoid. The default is "orthometric".
+        resolution: float, size of the pixels of the crop in degrees, optional.
+            It is rounded to a number of SRTM90 pixels dividing TILE_SIZE,
+            see resolution_factor. Only the pixels needed are read from the
+            tiles. The default is None, the SRTM90 resolution RES.
+        resampling: str, "nearest", "average" or "max", how the SRTM90
+            pixels are combined into the pixels of a lower resolution crop,
+            optional. The default is "nearest".
 
     Returns:
         raster: np.2darray of the dem crop
         transform: affine.Affine transform in px_is_area convention
         crs: rasterio.crs.CRS. always epsg:4326, even if orthometric (2D crs)
     """
-    lon_start, lat_min, lon_end, lat_max = bounds
-    offset = 0.1 * RES
-    assert lon_start <= lon_end, "Not valid lon interval"
-    lon_start = wrap_lon(lon_start)
-    lon_end = wrap_lon(lon_end)
-    # in this case , wrapping has occured on the interval at antimeridian
-    if lon_end < lon_start:
-
-        bounds_start = lon_start, lat_min, 180 - RES - offset, lat_max
-        bounds_end = -180 + offset, lat_min, lon_end, lat_max
+    start_time = time.perf_counter()
+    parts = split_at_antimeridian(bounds)
+    if len(parts) == 2:
+        bounds_start, bounds_end = parts
 
         raster_start, transform, crs = crop_at_continous_lon_limits(
-            bounds_start, datum=datum)
+            bounds_start, datum=datum, resolution=resolution,
+            resampling=resampling)
         raster_end, _, _ = crop_at_continous_lon_limits(
-            bounds_end, datum=datum)
+            bounds_end, datum=datum, resolution=resolution,
+            resampling=resampling)
 
         raster = np.hstack([raster_start, raster_end])
 
     else:
         raster, transform, crs = crop_at_continous_lon_limits(
-            bounds, datum=datum)
+            bounds, datum=datum, resolution=resolution, resampling=resampling)
+
+    if raster is not None:
+        metrics.add('crops')
+        metrics.add('pixels', raster.size)
+        metrics.add('crop_seconds', time.perf_counter() - start_time)
     return raster, transform, crs
 
 
+def crop_to_file(bounds, path, datum="orthometric", block_size=256,
+                 resolution=None, resampling="nearest"):
+    """
+    Write a crop of the SRTM90 dem at the specified bounds to a GeoTIFF file.\
+        The bounds can intersect the antimeridian.
+
+    The file is the same as the one written by write_crop_to_file from the
+    output of crop, but it is computed and written one block at a time, so
+    that the memory needed does not depend on the size of the crop.
+
+    Args:
+        bounds: geospatial bound tuple (lon_min, lat_min, lon_max, lat_max).
+        path (str): path to output file
+        datum: str, either "ellipsoidal" or "orthometric", see crop.
+            The default is "orthometric".
+        block_size (int): size of the square blocks of the file, a multiple
+            of 16, optional. The default is 256.
+        resolution, resampling: see crop.
+
+    Returns:
+        transform: affine.Affine transform in px_is_area convention
+        crs: rasterio.crs.CRS. always epsg:4326, even if orthometric (2D crs)
+    """
+    assert datum in [
+        "ellipsoidal", "orthometric"], "Datum must be either ellipsoidal or orthometric"
+
+    start_time = time.perf_counter()
+    factor = resolution_factor(resolution)
+    grids = [_crop_grid(part, factor) for part in split_at_antimeridian(bounds)]
+    if any(grid is None for grid in grids):
+        print("Lat coordinates out of coverage, crop will be skipped")
+        return None, None
+
+    # the parts of the crop are side by side, from west to east
+    transform = grids[0][1]
+    height = grids[0][2][0]
+    widths = [grid[2][1] for grid in grids]
+    offsets = np.cumsum([0] + widths[:-1])
+    width = sum(widths)
+    crs = rasterio.crs.CRS.from_epsg(4326)
+
+    profile = _crop_profile(width, height, np.float32, transform, crs,
+                            block_size)
+    with rasterio.open(path, "w", **profile) as f:
+        for row in range(0, height, block_size):
+            for col in range(0, width, block_size):
+                h = min(block_size, height - row)
+                w = min(block_size, width - col)
+                block = np.empty((h, w), dtype=np.float32)
+                for grid, offset, part_width in zip(grids, offsets, widths):
+                    start = max(col, offset)
+                    stop = min(col + w, offset + part_width)
+                    if start < stop:
+                        block[:, start - col:stop - col] = _crop_block(
+                            grid, row, start - offset, (h, stop - start), datum,
+                            resampling)
+                f.write(block, 1, window=rasterio.windows.Window(col, row, w, h))
+
+    metrics.add('crops')
+    metrics.add('pixels', width * height)
+    metrics.add('crop_seconds', time.perf_counter() - start_time)
+    return transform, crs
+
+
+def _crop_profile(width, height, dtype, transform, crs, block_size=256):
+    """Profile of the GeoTIFF files of the crops."""
+    return dict(driver="GTiff",
+                count=1,
+                width=width,
+                height=height,
+                dtype=dtype,
+                transform=transform,
+                crs=crs,
+                tiled=True,
+                compress="deflate",
+                predictor=2,
+                blockxsize=block_size,
+                blockysize=block_size)
+
+
 def write_crop_to_file(array, transform, crs, path):
     """
     Write a georeferenced raster to a GeoTIFF file.
@@ -452,18 +861,7 @@ def write_crop_to_file(array, transform, crs, path):
         path (str): path to output file
     """
     height, width = array.shape
-    profile = dict(driver="GTiff",
-                   count=1,
-                   width=width,
-                   height=height,
-                   dtype=array.dtype,
-                   transform=transform,
-                   crs=crs,
-                   tiled=True,
-                   compress="deflate",
-                   predictor=2,
-                   blockxsize=256,
-                   blockysize=256)
+    profile = _crop_profile(width, height, array.dtype, transform, crs)
 
     with rasterio.open(path, "w", **profile) as f:
         f.write(array, 1)
@@ -0,0 +1,176 @@
+"""
+Access to the int16 samples of the SRTM tiles.
+
+Each tile srtm_XX_YY.tif of the cache has a sidecar srtm_XX_YY.npy holding its
+raw samples, written once on first use. The sidecars are memory-mapped, so
+that only the pages that are touched are read, and the page cache is shared
+by all the processes of the host. Set SRTM4_SIDECAR=0 to disable them.
+"""
+import os
+import struct
+from functools import lru_cache
+
+import numpy as np
+
+from srtm4 import metrics
+from srtm4 import _native
+
+TILE_SIZE = 6000
+
+# number of tiles decoded without sidecar kept in memory (72 MB each)
+DECODED_TILES = 4
+
+
+def sidecars_enabled():
+    """Tell whether the sidecars may be written (SRTM4_SIDECAR is not 0)."""
+    return os.getenv('SRTM4_SIDECAR', '1') != '0'
+
+
+def tile_paths(srtm_tile, out_dir):
+    """
+    Paths of the tif file and of the sidecar of a tile.
+
+    Args:
+        srtm_tile: string following the pattern 'srtm_%02d_%02d'
+        out_dir: directory where the srtm tiles are stored
+
+    Returns:
+        tif_path, npy_path
+    """
+    base = os.path.join(os.path.abspath(os.path.expanduser(out_dir)), srtm_tile)
+    return base + '.tif', base + '.npy'
+
+
+def _read_uncompressed_tif(tif_path):
+    """
+    Read the int16 samples of an uncompressed, striped, single band tif file.
+
+    Returns:
+        2D int16 array, or None if the file has another layout
+    """
+    with open(tif_path, 'rb') as f:
+        head = f.read(8)
+        byteorder = {b'II': '<', b'MM': '>'}.get(head[:2])
+        if byteorder is None:
+            return None
+        magic, ifd_offset = struct.unpack(byteorder + 'HI', head[2:])
+        if magic != 42:  # BigTIFF
+            return None
+
+        # read the tags of the first image file directory
+        f.seek(ifd_offset)
+        count, = struct.unpack(byteorder + 'H', f.read(2))
+        entries = f.read(12 * count)
+        tags = {}
+        for i in range(count):
+            tag, typ, n = struct.unpack(byteorder + 'HHI',
+                                        entries[12 * i: 12 * i + 8])
+            if typ not in (3, 4):  # SHORT, LONG
+                continue
+            fmt = byteorder + ('H' if typ == 3 else 'I')
+            size = struct.calcsize(fmt) * n
+            value = entries[12 * i + 8: 12 * i + 12]
+            if size > 4:
+                f.seek(struct.unpack(byteorder + 'I', value)[0])
+                value = f.read(size)
+            tags[tag] = np.frombuffer(value[:size], dtype=fmt)
+
+    def tag(code, default=None):
+        return int(tags[code][0]) if code in tags else default
+
+    width, height = tag(256), tag(257)
+    if (tag(258) != 16 or tag(259, 1) != 1 or tag(277, 1) != 1
+            or 273 not in tags or 322 in tags):
+        return None
+    rows_per_strip = min(tag(278, height), height)
+
+    data = np.empty((height, width), dtype=np.int16)
+    raw = np.memmap(tif_path, dtype=np.uint8, mode='r')
+    for i, offset in enumerate(tags[273]):
+        row = i * rows_per_strip
+        rows = min(rows_per_strip, height - row)
+        strip = raw[offset: offset + 2 * rows * width]
+        data[row: row + rows] = strip.view(byteorder + 'i2').reshape(rows,
+                                                                     width)
+    return data
+
+
+def _decode_tif(tif_path):
+    """Read the int16 samples of a tif tile, with rasterio if needed."""
+    data = _read_uncompressed_tif(tif_path)
+    if data is not None:
+        return data
+    try:
+        import rasterio
+    except ImportError:
+        raise RuntimeError("reading {} needs the srtm4 library or "
+                           "rasterio".format(tif_path))
+    with rasterio.open(tif_path, 'r') as f:
+        return f.read(1)
+
+
+def _write_sidecar(npy_path, data):
+    """Write the sidecar of a tile atomically."""
+    tmp = '{}.{}.tmp'.format(npy_path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.lib.format.write_array(f, data, allow_pickle=False)
+        os.replace(tmp, npy_path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+@lru_cache(maxsize=DECODED_TILES)
+def _decoded_tile(tif_path, mtime_ns, size):
+    """
+    Decode a tile once, for the reads without sidecar. The modification time
+    and size of the file are part of the key, so that a replaced file is
+    decoded again.
+    """
+    metrics.add('tiles_decoded')
+    with metrics.timer('tile_decode_seconds'):
+        data = _decode_tif(tif_path)
+    data.flags.writeable = False
+    return data
+
+
+def read_tile(srtm_tile, out_dir):
+    """
+    Get the int16 samples of a tile of the cache.
+
+    Args:
+        srtm_tile: string following the pattern 'srtm_%02d_%02d'
+        out_dir: directory where the srtm tiles are stored
+
+    Returns:
+        (6000, 6000) int16 array, memory-mapped from the sidecar when possible,
+        read-only. Without sidecars, the last DECODED_TILES tiles decoded are
+        kept in memory
+
+    Raises:
+        FileNotFoundError: if the tile is not in the cache
+    """
+    tif_path, npy_path = tile_paths(srtm_tile, out_dir)
+    metrics.add('tiles_read')
+    if not os.path.exists(npy_path):
+        if not os.path.exists(tif_path):
+            raise FileNotFoundError(tif_path)
+        if not sidecars_enabled():
+            st = os.stat(tif_path)
+            return _decoded_tile(tif_path, st.st_mtime_ns, st.st_size)
+        metrics.add('tiles_decoded')
+        with metrics.timer('tile_decode_seconds'):
+            lib = _native.load()
+            if lib is not None:
+                lon_id, lat_id = (int(x) for x in srtm_tile.split('_')[1:])
+                lib.srtm4_write_sidecar(os.path.dirname(npy_path).encode(),
+                                        lon_id, lat_id)
+            if not os.path.exists(npy_path):
+                data = _decode_tif(tif_path)
+                if not _write_sidecar(npy_path, data):
+                    return data
+
+    return np.load(npy_path, mmap_mode='r')
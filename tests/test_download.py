@@ -0,0 +1,97 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from srtm4 import download
+from srtm4.__main__ import main
+
+
+class _Unseekable(io.RawIOBase):
+    """Write-only stream, so that zipfile writes data descriptors."""
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buffer.write(b)
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_extract_zip_stream(compression, seekable):
+    payload = bytes(range(256)) * 5000
+    f = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(f, "w", compression) as z:
+        z.writestr("readme.txt", "hello" * 100)
+        z.writestr("srtm_37_03.tif", payload)
+    archive = f.getvalue() if seekable else f.buffer.getvalue()
+    chunks = (archive[i:i + 1000] for i in range(0, len(archive), 1000))
+
+    out = io.BytesIO()
+    if compression == zipfile.ZIP_STORED and not seekable:
+        with pytest.raises(download.UnstreamableZipError):
+            download.extract_zip_stream(chunks, "srtm_37_03.tif", out)
+    else:
+        assert download.extract_zip_stream(chunks, "srtm_37_03.tif", out)
+        assert out.getvalue() == payload
+
+
+def test_extract_zip_stream_not_a_zip():
+    out = io.BytesIO()
+    assert not download.extract_zip_stream([b"<html>not here</html>"],
+                                           "srtm_37_03.tif", out)
+    assert not download.extract_zip_stream([], "srtm_37_03.tif", out)
+
+
+def _mirror(tmp_path, tiles):
+    """Directory of srtm_XX_YY.zip archives, to be served as a file:// url."""
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    for name, payload in tiles.items():
+        with zipfile.ZipFile(mirror / "{}.zip".format(name), "w",
+                             zipfile.ZIP_DEFLATED) as z:
+            z.writestr("{}.tif".format(name), payload)
+    return mirror.as_uri()
+
+
+def test_get_srtm_tiles_file_url(tmp_path):
+    url = _mirror(tmp_path, {"srtm_37_03": b"37_03" * 1000})
+    cache = tmp_path / "cache"
+
+    present = download.get_srtm_tiles(["srtm_37_03", "srtm_38_03"], str(cache),
+                                      skip_unavailable=True, base_url=url)
+    assert present == ["srtm_37_03"]
+    assert (cache / "srtm_37_03.tif").read_bytes() == b"37_03" * 1000
+
+    with pytest.raises(ConnectionError):
+        download.get_srtm_tile("srtm_38_03", str(cache), base_url=url)
+
+
+def test_warm_and_check(tmp_path, capsys):
+    url = _mirror(tmp_path, {"srtm_37_03": b"37_03" * 1000,
+                             "srtm_38_03": b"38_03" * 1000})
+    cache = str(tmp_path / "cache")
+
+    assert main(["warm", "--bounds", "2", "47", "7", "48", "--base-url", url,
+                 "--cache", cache]) == 0
+    with open(tmp_path / "cache" / download.MANIFEST) as f:
+        tiles = json.load(f)["tiles"]
+    assert sorted(tiles) == ["srtm_37_03", "srtm_38_03"]
+    assert tiles["srtm_37_03"]["size"] == 5000
+    assert download.read_manifest(cache) == tiles
+
+    assert main(["check", "--cache", cache]) == 0
+    with open(tmp_path / "cache" / "srtm_38_03.tif", "ab") as f:
+        f.write(b"x")
+    assert main(["check", "--cache", cache]) == 1
+    assert download.check_manifest(cache) == ["srtm_38_03"]
+
+    # unavailable tiles fail the warm-up, unless they are skipped
+    assert main(["warm", "--tiles", "srtm_01_01", "--base-url", url,
+                 "--cache", cache]) == 1
+    assert main(["warm", "--tiles", "srtm_01_01", "--base-url", url,
+                 "--cache", cache, "--skip-unavailable"]) == 0
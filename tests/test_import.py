@@ -0,0 +1,54 @@
+import subprocess
+import sys
+
+
+def test_import_time():
+    # import srtm4 in a fresh interpreter, with the timings of -X importtime
+    # on stderr: "import time: self [us] | cumulative | imported package"
+    code = ("import sys, srtm4; print(' '.join(m for m in "
+            "('rasterio', 'pyproj', 'affine', 'requests') if m in sys.modules))")
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                       capture_output=True, text=True, check=True)
+
+    # the raster stack and requests are imported on first use only
+    assert p.stdout.split() == []
+
+    cumulative = {}
+    for line in p.stderr.splitlines():
+        if line.startswith("import time:"):
+            _, total, name = line.split("|")
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+
+    # time spent beyond numpy, in microseconds
+    overhead = cumulative["srtm4"] - cumulative.get("numpy", 0)
+    assert overhead < 200000, "import srtm4 takes {} ms besides numpy".format(
+        overhead // 1000)
+
+
+def test_native_load_concurrent():
+    # the first calls to load, from several threads at once, all get the
+    # library (or all None when it is not built)
+    code = ("import os, threading; from srtm4 import _native\n"
+            "barrier = threading.Barrier(8); libs = []\n"
+            "def f(): barrier.wait(); libs.append(_native.load())\n"
+            "threads = [threading.Thread(target=f) for _ in range(8)]\n"
+            "[t.start() for t in threads]; [t.join() for t in threads]\n"
+            "print(len(set(map(id, libs))), libs[0] is not None, "
+            "os.path.exists(_native.LIB))")
+    p = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                       text=True, check=True)
+    count, loaded, built = p.stdout.split()
+    assert count == "1"
+    assert loaded == built
+
+
+def test_raster_without_rasterio():
+    # rasterio cannot be imported: crop is missing, with a hint to install it
+    code = ("import sys; sys.modules['rasterio'] = None; import srtm4\n"
+            "print(hasattr(srtm4, 'crop'), getattr(srtm4, 'crop', None))\n"
+            "try: srtm4.crop\n"
+            "except AttributeError as e: print('srtm4[crop]' in str(e))")
+    p = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                       text=True, check=True)
+    assert p.stdout.split() == ["False", "None", "True"]
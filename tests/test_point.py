@@ -1,3 +1,7 @@
+import os
+import subprocess
+import time
+
 import pytest
 import numpy as np
 
@@ -15,4 +19,468 @@ def test_srtm4(longitude, latitude, exp_altitude, tmp_path, monkeypatch):
     import srtm4
 
     altitude = srtm4.srtm4(longitude, latitude)
-    assert altitude == exp_altitude
+    np.testing.assert_allclose(altitude, exp_altitude, atol=1e-3)
+
+
+@pytest.mark.parametrize("engine", ["native", "subprocess", "numpy"])
+def test_srtm4_engines(engine, tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    altitude = srtm4.srtm4([2, 2.0005], [48, 48.0005], engine=engine)
+    reference = srtm4.srtm4([2, 2.0005], [48, 48.0005], engine="native")
+    np.testing.assert_allclose(altitude, reference, atol=1e-2)
+    np.testing.assert_allclose(altitude[0], 174.613, atol=1e-2)
+
+
+@pytest.mark.parametrize("engine", ["native", "subprocess", "numpy"])
+@pytest.mark.parametrize("interpolation", ["nearest", "bilinear", "bicubic"])
+def test_srtm4_interpolation(interpolation, engine):
+    import srtm4
+
+    # the second point is next to the border of srtm_37_03 and srtm_38_03
+    lons, lats = [2.0004, 4.9999], [48.0003, 48.0003]
+    heights = srtm4.srtm4(lons, lats, interpolation=interpolation, engine=engine)
+    reference = srtm4.srtm4(lons, lats, interpolation=interpolation,
+                            engine="native")
+    np.testing.assert_allclose(heights, reference, atol=1e-2)
+
+
+def test_srtm4_bicubic_across_tiles():
+    import srtm4
+
+    # bicubic reads the neighbouring tile, so it is continuous at the border
+    heights = srtm4.srtm4([5 - 1e-9, 5 + 1e-9], [48, 48], interpolation="bicubic")
+    assert abs(heights[0] - heights[1]) < 1e-2
+
+
+def test_srtm4_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import srtm4
+
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(2, 7, 100000)
+    lats = rng.uniform(47.5, 48.5, 100000)
+    monkeypatch.setenv("SRTM4_THREADS", "1")
+    reference = srtm4.srtm4(lons, lats, interpolation="bicubic",
+                            engine="native")
+
+    # the batch split across threads, and concurrent batches
+    monkeypatch.setenv("SRTM4_THREADS", "4")
+    heights = srtm4.srtm4(lons, lats, interpolation="bicubic", engine="native")
+    np.testing.assert_array_equal(heights, reference)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        parts = list(pool.map(
+            lambda i: srtm4.srtm4(lons[i::4], lats[i::4],
+                                  interpolation="bicubic", engine="native"),
+            range(4)))
+    for i, part in enumerate(parts):
+        np.testing.assert_array_equal(part, reference[i::4])
+
+
+def test_srtm4_out(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    out = np.empty(2)
+    altitude = srtm4.srtm4(np.array([2, 2]), np.array([48, 48]), out=out)
+    assert altitude is out
+    np.testing.assert_allclose(out, [174.613, 174.613], atol=1e-3)
+
+    with pytest.raises(ValueError):
+        srtm4.srtm4([2, 2], [48, 48], out=np.empty(3))
+
+
+def test_srtm4_iter(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    points = np.array([[2, 48], [2.0005, 48.0005], [2.001, 48.001]])
+    expected = srtm4.srtm4(points[:, 0], points[:, 1])
+
+    chunks = list(srtm4.srtm4_iter(points, chunk_size=2))
+    assert [len(c) for c in chunks] == [2, 1]
+    np.testing.assert_array_equal(np.concatenate(chunks), expected)
+
+    chunks = srtm4.srtm4_iter([(points[:2, 0], points[:2, 1]), points[2:]])
+    np.testing.assert_array_equal(np.concatenate(list(chunks)), expected)
+
+    np.save(tmp_path / "points.npy", points)
+    heights = srtm4.srtm4_file(tmp_path / "points.npy", tmp_path / "heights.npy",
+                               chunk_size=2)
+    np.testing.assert_array_equal(heights, expected)
+    np.testing.assert_array_equal(np.load(tmp_path / "heights.npy"), expected)
+
+
+@pytest.mark.parametrize("interpolation", ["nearest", "bilinear", "bicubic"])
+def test_srtm4_grid(interpolation, tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    # across the border of srtm_37_03 and srtm_38_03
+    lon_axis = np.linspace(4.99, 5.01, 31)
+    lat_axis = np.linspace(48.01, 47.99, 21)
+    lons, lats = np.meshgrid(lon_axis, lat_axis)
+
+    heights = srtm4.srtm4_grid(lon_axis, lat_axis, datum="orthometric",
+                               interpolation=interpolation)
+    assert heights.shape == (21, 31)
+    expected = srtm4.srtm4(lons, lats, datum="orthometric",
+                           interpolation=interpolation, engine="numpy")
+    np.testing.assert_allclose(heights, expected)
+
+    # the geoid is interpolated bilinearly
+    heights = srtm4.srtm4_grid(lon_axis, lat_axis, interpolation=interpolation)
+    expected = srtm4.srtm4(lons, lats, interpolation=interpolation)
+    np.testing.assert_allclose(heights, expected, atol=0.2)
+
+
+def test_profile(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    # along a meridian the samples are spaced regularly in latitude
+    distances, heights = srtm4.profile([(2, 48), (2, 48.01)], 100)
+    length = srtm4.point.EARTH_RADIUS * np.radians(0.01)
+    np.testing.assert_allclose(distances[-1], length)
+    np.testing.assert_allclose(np.diff(distances[:-1]), 100)
+    lats = 48 + np.degrees(distances / srtm4.point.EARTH_RADIUS)
+    np.testing.assert_allclose(heights, srtm4.srtm4(np.full(len(lats), 2), lats),
+                               atol=1e-2)
+
+    # the vertices of a polyline are on the path
+    path = [(2, 48), (2.01, 48), (2.01, 48.01)]
+    distances, heights = srtm4.profile(path, 50, chunk_size=7)
+    assert np.all(np.diff(distances) > 0)
+    np.testing.assert_allclose(heights[[0, -1]], srtm4.srtm4([2, 2.01], [48, 48.01]),
+                               atol=1e-2)
+
+
+def test_stats(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    srtm4.reset_stats()
+    events = []
+    srtm4.set_stats_callback(lambda name, value: events.append((name, value)))
+    try:
+        srtm4.srtm4([2, 2.1], [48, 48.1])
+        srtm4.srtm4_grid([2, 2.1, 2.2], [48, 47.9])
+    finally:
+        srtm4.set_stats_callback(None)
+
+    stats = srtm4.stats(reset=True)
+    assert stats["points"] == 8
+    assert stats["query_seconds"] > 0
+    assert stats["points_per_s"] == stats["points"] / stats["query_seconds"]
+    assert ("points", 2) in events and ("points", 6) in events
+    assert "points" not in srtm4.stats()
+
+
+def test_srtm4_orthometric(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    altitude = srtm4.srtm4(2, 48, datum="orthometric")
+    np.testing.assert_allclose(altitude, 174.613 - 45.613, atol=1e-3)
+
+
+def test_srtm4_server(tmp_path, monkeypatch):
+    import srtm4
+    from srtm4 import point
+
+    socket_path = str(tmp_path / "srtm4.sock")
+    server = subprocess.Popen([os.path.join(point.BIN, "srtm4"), "-s", socket_path],
+                              env={"SRTM4_CACHE": point.SRTM_DIR,
+                                   "GEOID_PATH": point.GEOID})
+    try:
+        for _ in range(50):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        monkeypatch.setenv("SRTM4_SOCKET", socket_path)
+        altitude = srtm4.srtm4([2, 2.0005], [48, 48.0005], engine="server")
+        reference = srtm4.srtm4([2, 2.0005], [48, 48.0005], engine="native")
+        np.testing.assert_array_equal(altitude, reference)
+        np.testing.assert_allclose(altitude[0], 174.613, atol=1e-3)
+    finally:
+        server.terminate()
+        server.wait()
+    assert not os.path.exists(socket_path)
+
+    # without the server, the next engine is used
+    np.testing.assert_allclose(srtm4.srtm4(2, 48), 174.613, atol=1e-3)
+
+
+def test_geoid_height():
+    import srtm4
+
+    heights = srtm4.geoid_height(np.array([2, 2]), np.array([48, 48]))
+    np.testing.assert_allclose(heights, [45.613, 45.613], atol=1e-3)
+
+
+def test_geoid_height_numpy():
+    import srtm4.geoid
+
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(-360, 360, 10000)
+    lats = rng.uniform(-90, 90, 10000)
+    lats[:4] = [90, -90, 89.9, -89.9]
+    np.testing.assert_allclose(srtm4.geoid._geoid_height_numpy(lons, lats),
+                               srtm4.geoid_height(lons, lats), atol=1e-6)
+
+
+def test_geoid_height_grid():
+    import srtm4.geoid
+
+    lon_axis = np.linspace(-3, 3, 41)
+    lat_axis = np.linspace(48, 45, 31)
+    heights = srtm4.geoid.geoid_height_grid(lon_axis, lat_axis, block_rows=8)
+    assert heights.shape == (31, 41)
+    lons, lats = np.meshgrid(lon_axis, lat_axis)
+    np.testing.assert_allclose(heights, srtm4.geoid_height(lons, lats), atol=0.2)
+
+    # at the nodes of the 15' grid, the heights are the grid values
+    raw, offset, scale = srtm4.geoid.egm96_grid()
+    heights = srtm4.geoid.geoid_height_grid([2, 359.75], [48])
+    np.testing.assert_allclose(heights[0], offset + scale * raw[168, [8, 1439]])
+
+
+def test_geoid_height_grid_memory(monkeypatch):
+    import tracemalloc
+    import srtm4.geoid
+
+    # a tall grid spans many rows of the 15' grid: the memory needed beyond
+    # the result is bounded by the blocks, whatever the latitude span
+    lon_axis = np.linspace(-10, 10, 4000)
+    lat_axis = np.linspace(60, -60, 600)
+    reference = srtm4.geoid.geoid_height_grid(lon_axis, lat_axis, block_rows=1)
+    monkeypatch.setattr(srtm4.geoid, "GRID_BLOCK_SIZE", 1 << 14)
+    tracemalloc.start()
+    try:
+        heights = srtm4.geoid.geoid_height_grid(lon_axis, lat_axis)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    np.testing.assert_array_equal(heights, reference)
+    assert peak - heights.nbytes < 2 * 10**6
+
+
+def test_read_tile(tmp_path):
+    import srtm4.tiles
+
+    srtm4.get_srtm_tile("srtm_37_03", str(tmp_path))
+    data = srtm4.tiles.read_tile("srtm_37_03", str(tmp_path))
+    assert isinstance(data, np.memmap)
+    assert data.shape == (6000, 6000)
+    assert data.dtype == np.int16
+    assert data[2400, 2400] == 129  # orthometric height at (2, 48)
+    assert (tmp_path / "srtm_37_03.npy").exists()
+
+
+def _write_tile(rasterio, path, seed=0):
+    """Write a synthetic, striped srtm_37_03 tile."""
+    size = 6000
+    data = (np.arange(size)[:, None] * 7 % 1000 +
+            np.arange(size) % 300 + seed).astype(np.int16)
+    data[:100, :100] = -32768
+    with rasterio.open(path, "w", driver="GTiff", width=size, height=size,
+                       count=1, dtype="int16", nodata=-32768, crs="EPSG:4326",
+                       transform=rasterio.transform.from_origin(
+                           0, 50, 5 / size, 5 / size)) as f:
+        f.write(data, 1)
+    return data
+
+
+def test_read_tile_cache_dirs(tmp_path, monkeypatch):
+    rasterio = pytest.importorskip("rasterio")
+    from concurrent.futures import ThreadPoolExecutor
+    import srtm4
+    from srtm4 import _native
+
+    lib = _native.load()
+    if lib is None:
+        pytest.skip("the srtm4 library is not built")
+
+    # the native engine reads the cache a, the numpy one reads copies of
+    # another tile in the directories b0, b1, ...
+    (tmp_path / "a").mkdir()
+    _write_tile(rasterio, str(tmp_path / "a" / "srtm_37_03.tif"))
+    data = _write_tile(rasterio, str(tmp_path / "b.tif"), seed=1000)
+    monkeypatch.setattr(srtm4.point, "SRTM_DIR", str(tmp_path / "a"))
+    lons, lats = np.array([1.0, 2.5, 4.0]), np.array([46.0, 47.5, 49.0])
+    lib.srtm4_free_tiles()
+    srtm4.tile_cache_stats(reset=True)
+    reference = srtm4.srtm4(lons, lats, datum="orthometric", engine="native")
+
+    def numpy_read(i):
+        b = tmp_path / "b{}".format(i)
+        b.mkdir()
+        os.link(str(tmp_path / "b.tif"), str(b / "srtm_37_03.tif"))
+        return srtm4.tiles.read_tile("srtm_37_03", str(b))
+
+    def native_query(i):
+        return srtm4.srtm4(lons, lats, datum="orthometric", engine="native")
+
+    # the sidecars of the numpy reads neither redirect the native queries nor
+    # drop the tile loaded by them
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        reads = pool.map(numpy_read, range(4))
+        queries = pool.map(native_query, range(8))
+        for tile in reads:
+            np.testing.assert_array_equal(tile, data)
+        for heights in queries:
+            np.testing.assert_array_equal(heights, reference)
+    assert srtm4.tile_cache_stats()["misses"] == 1
+
+
+def test_read_tile_without_sidecar(tmp_path, monkeypatch):
+    rasterio = pytest.importorskip("rasterio")
+    import srtm4.tiles
+
+    monkeypatch.setenv("SRTM4_SIDECAR", "0")
+    path = str(tmp_path / "srtm_37_03.tif")
+    data = _write_tile(rasterio, path)
+    srtm4.tiles._decoded_tile.cache_clear()
+    decoded = srtm4.tiles._decode_tif
+    calls = []
+    monkeypatch.setattr(srtm4.tiles, "_decode_tif",
+                        lambda p: calls.append(p) or decoded(p))
+
+    # the tile is decoded once, then served from memory until replaced
+    for _ in range(3):
+        tile = srtm4.tiles.read_tile("srtm_37_03", str(tmp_path))
+        np.testing.assert_array_equal(tile, data)
+    assert not tile.flags.writeable
+    assert len(calls) == 1
+    data = _write_tile(rasterio, path, seed=1000)
+    np.testing.assert_array_equal(
+        srtm4.tiles.read_tile("srtm_37_03", str(tmp_path)), data)
+    assert len(calls) == 2
+    assert not (tmp_path / "srtm_37_03.npy").exists()
+
+
+@pytest.mark.parametrize("tiled", [False, True])
+def test_srtm4_lazy_tile(tiled, tmp_path, monkeypatch):
+    rasterio = pytest.importorskip("rasterio")
+    import srtm4
+    from srtm4 import _native, download
+
+    lib = _native.load()
+    if lib is None:
+        pytest.skip("the srtm4 library is not built")
+
+    # fresh synthetic tile, striped as the CGIAR ones, or tiled by retile
+    path = str(tmp_path / "srtm_37_03.tif")
+    _write_tile(rasterio, path)
+    if tiled:
+        assert download.retile(path)
+    monkeypatch.setattr(srtm4.point, "SRTM_DIR", str(tmp_path))
+
+    # sparse points, some of them straddling the blocks of 64 or 256 rows
+    rows = np.array([0.3, 63.5, 255.5, 256.2, 1000.7, 4095.5, 5998.1])
+    cols = np.array([0.2, 100.5, 3000.5, 5998.7, 17.1, 2048.5, 64.4])
+    lons, lats = cols / 1200, 50 - rows / 1200
+
+    # the tile is only partly decoded, so it has no sidecar yet
+    lib.srtm4_free_tiles()
+    srtm4.reset_stats()
+    heights = srtm4.srtm4(lons, lats, datum="orthometric", engine="native")
+    assert not (tmp_path / "srtm_37_03.npy").exists()
+
+    # the library counts the blocks decoded and the geoid heights evaluated
+    stats = srtm4.stats()
+    assert 0 < stats["tile_cache_blocks"] <= 2 * rows.size
+    assert stats["geoid_points"] == 0
+    srtm4.srtm4(lons, lats, datum="ellipsoidal", engine="native")
+    stats = srtm4.stats(reset=True)
+    assert stats["tile_cache_blocks"] <= 2 * rows.size
+    assert stats["geoid_points"] == rows.size
+    assert srtm4.stats()["geoid_points"] == 0
+
+    # the other blocks are decoded with the layout of the tif file opened
+    # first, even if the file is replaced by another layout meanwhile
+    assert download.retile(path, block_size=128 if tiled else 256)
+    other_lats = 50 - (rows + 1500.3) % 5990 / 1200
+    others = srtm4.srtm4(lons, other_lats, datum="orthometric",
+                         engine="native")
+
+    monkeypatch.setenv("SRTM4_SIDECAR", "0")
+    for interpolation in ["nearest", "bilinear"]:
+        lib.srtm4_free_tiles()
+        native = srtm4.srtm4(lons, lats, datum="orthometric", engine="native",
+                             interpolation=interpolation)
+        reference = srtm4.srtm4(lons, lats, datum="orthometric",
+                                engine="numpy", interpolation=interpolation)
+        np.testing.assert_allclose(native, reference, atol=1e-2)
+    np.testing.assert_array_equal(heights, native)
+    np.testing.assert_allclose(
+        others, srtm4.srtm4(lons, other_lats, datum="orthometric",
+                            engine="numpy"), atol=1e-2)
+    assert not (tmp_path / "srtm_37_03.npy").exists()
+
+
+def test_tile_cache_budget(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import srtm4
+
+    srtm4.set_max_tile_bytes(100 * 10**6)  # room for a single tile
+    try:
+        srtm4.tile_cache_stats(reset=True)
+        srtm4.srtm4([2, 7, 2], [48, 48, 48])
+        stats = srtm4.tile_cache_stats()
+
+        # the threads of a batch pin both tiles at once, over the budget, and
+        # the extra one is evicted once released
+        monkeypatch.setenv("SRTM4_THREADS", "4")
+        lons = np.repeat([2.0, 7.0, 2.0, 7.0], 16384)
+        srtm4.srtm4(lons, np.full(lons.size, 48.0))
+        batch_stats = srtm4.tile_cache_stats()
+    finally:
+        srtm4.set_max_tile_bytes(0)
+    assert stats["misses"] == 3
+    assert stats["evictions"] >= 2
+    assert stats["tiles"] == 1
+    assert stats["bytes"] <= 100 * 10**6
+    assert batch_stats["tiles"] == 1
+    assert batch_stats["bytes"] <= batch_stats["max_bytes"]
+
+
+def test_srtm4_which_tiles():
+    import srtm4
+
+    lons, lats = [2, 7, 2, -180, 179.9], [48, 43, 48, 0, -59]
+    tiles, index = srtm4.srtm4_which_tiles(lons, lats)
+    assert tiles.tolist() == [[1, 13], [37, 3], [38, 4], [72, 24]]
+    assert index.tolist() == [1, 2, 1, 0, 3]
+    assert srtm4.srtm4_which_tile(lons, lats) == [
+        "srtm_37_03", "srtm_38_04", "srtm_37_03", "srtm_01_13", "srtm_72_24"]
+
+
+def test_tiles_in_bounds():
+    import srtm4.point
+
+    tiles = srtm4.point.tiles_in_bounds((175, -20, 185, -19))
+    assert tiles.tolist() == [[72, 16], [1, 16], [2, 16],
+                              [72, 17], [1, 17], [2, 17]]
+
+
+def test_prefetch(tmp_path, monkeypatch):
+    import srtm4.point
+    monkeypatch.setattr(srtm4.point, "SRTM_DIR", str(tmp_path))
+
+    tiles = srtm4.prefetch((2, 47, 7, 48), max_workers=2)
+    assert tiles == ["srtm_37_03", "srtm_38_03"]
+    for tile in tiles:
+        assert (tmp_path / "{}.tif".format(tile)).exists()
+
+
+def test_get_srtm_tile_concurrent(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    import srtm4
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda t: srtm4.get_srtm_tile(t, str(tmp_path)),
+                      ["srtm_37_03"] * 4))
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert files == ["srtm_37_03.lock", "srtm_37_03.tif"]
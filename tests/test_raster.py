@@ -56,3 +56,147 @@ def test_crop(bound, datum, expected_shape, tmp_path, monkeypatch):
         alts = np.reshape(srtm4.srtm4(x, y), raster_shape)
 
         np.testing.assert_allclose(raster[mask], alts[mask], atol=0, rtol=1e-2)
+
+
+@pytest.mark.parametrize(
+    "bound, datum",
+    [
+     ((21.33, -3.78, 21.66, -2.97), "ellipsoidal"),
+     ((179, -20, 181, -19), "orthometric"),
+     ]
+    )
+def test_crop_to_file(bound, datum, tmp_path):
+    raster, transform, crs = srtm4.crop(bound, datum=datum)
+    srtm4.raster.write_crop_to_file(raster, transform, crs,
+                                    str(tmp_path / "crop.tif"))
+
+    # small blocks, so that the antimeridian falls inside a block
+    block_transform, _ = srtm4.crop_to_file(bound, str(tmp_path / "blocks.tif"),
+                                            datum=datum, block_size=64)
+    assert block_transform == transform
+
+    with rasterio.open(str(tmp_path / "crop.tif")) as a, \
+            rasterio.open(str(tmp_path / "blocks.tif")) as b:
+        assert a.profile == b.profile | {"blockxsize": 256, "blockysize": 256}
+        np.testing.assert_array_equal(a.read(1), b.read(1))
+
+
+@pytest.mark.parametrize("resampling", ["nearest", "average", "max"])
+def test_crop_resolution(resampling):
+    bound = (21.33, -3.78, 21.66, -2.97)
+    full, full_transform, _ = srtm4.crop(bound)
+    raster, transform, _ = srtm4.crop(bound, resolution=0.01,
+                                      resampling=resampling)
+    factor = srtm4.raster.resolution_factor(0.01)
+    assert factor == 12
+    assert transform.a == factor * srtm4.raster.RES
+
+    # blocks of the full resolution crop under the pixels of the crop
+    col, row = (round(-v) for v in ~full_transform * (transform.c, transform.f))
+    height, width = raster.shape
+    covered = np.full((height * factor, width * factor), np.nan, dtype=full.dtype)
+    covered[row:row + full.shape[0], col:col + full.shape[1]] = full
+    blocks = covered.reshape(height, factor, width, factor)
+
+    # the border pixels of the crop also cover pixels out of the bounds
+    blocks = blocks[1:-1, :, 1:-1, :]
+    inner = raster[1:-1, 1:-1]
+    if resampling == "nearest":
+        assert (blocks == inner[:, None, :, None]).any(axis=(1, 3)).all()
+    elif resampling == "average":
+        np.testing.assert_allclose(inner, np.nanmean(blocks, axis=(1, 3)),
+                                   rtol=1e-5)
+    else:
+        np.testing.assert_array_equal(inner, np.nanmax(blocks, axis=(1, 3)))
+
+
+def test_crop_to_file_pool(tmp_path, monkeypatch):
+    # the 4 tiles of the crop do not fit in the pool, but each block only
+    # leases the tiles it intersects, so that they are not reopened by each
+    monkeypatch.setattr(srtm4.raster, "DATASETS",
+                        srtm4.raster.DatasetPool(max_size=2))
+    opens = []
+    rasterio_open = rasterio.open
+
+    def counting_open(path, mode="r", *args, **kwargs):
+        if mode == "r":
+            opens.append(path)
+        return rasterio_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(rasterio, "open", counting_open)
+    bound = (4.9, 44.9, 5.1, 45.1)
+    srtm4.crop_to_file(bound, str(tmp_path / "blocks.tif"), block_size=64)
+    assert len(set(opens)) == 4
+    assert len(opens) <= 8
+
+    monkeypatch.setattr(rasterio, "open", rasterio_open)
+    raster, _, _ = srtm4.crop(bound)
+    with rasterio.open(str(tmp_path / "blocks.tif")) as f:
+        np.testing.assert_array_equal(f.read(1), raster)
+
+
+def test_dataset_pool(tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / "{}.tif".format(i))
+        srtm4.raster.write_crop_to_file(np.full((4, 4), i, dtype="f4"),
+                                        rasterio.Affine(1, 0, 0, 0, -1, 0),
+                                        rasterio.crs.CRS.from_epsg(4326), path)
+        paths.append(path)
+
+    pool = srtm4.raster.DatasetPool(max_size=2)
+    with pool.lease(paths) as datasets:
+        assert [d.read(1)[0, 0] for d in datasets] == [0, 1, 2]
+        # a leased dataset is not shared
+        with pool.lease(paths[:1]) as other:
+            assert other[0] is not datasets[0]
+    # the least recently released datasets are closed
+    assert len(pool) == 2
+    assert other[0].closed and datasets[0].closed
+    assert not datasets[1].closed and not datasets[2].closed
+
+    with pool.lease(paths[2:]) as again:
+        assert again[0] is datasets[2]
+
+    pool.close()
+    assert len(pool) == 0
+    assert datasets[2].closed
+
+
+def test_retile(tmp_path, monkeypatch):
+    from srtm4 import download, _native
+
+    # striped tile, as the CGIAR ones
+    size = srtm4.raster.TILE_SIZE
+    data = (np.arange(size)[:, None] % 700 + np.arange(size) % 300).astype(np.int16)
+    data[:100, :100] = -32768
+    transform = rasterio.transform.from_origin(0, 50, srtm4.raster.RES,
+                                               srtm4.raster.RES)
+    path = str(tmp_path / "srtm_37_03.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=size, height=size,
+                       count=1, dtype="int16", nodata=-32768, crs="EPSG:4326",
+                       transform=transform) as f:
+        f.write(data, 1)
+
+    assert download.retile(path)
+    assert not download.retile(path)
+    with rasterio.open(path) as f:
+        assert f.profile["tiled"] and f.block_shapes == [(256, 256)]
+        assert f.profile["compress"] == "deflate"
+        assert f.transform == transform and f.nodata == -32768
+        np.testing.assert_array_equal(f.read(1), data)
+
+    # the srtm4 library reads the tiled file
+    lib = _native.load()
+    if lib is not None:
+        monkeypatch.setenv("SRTM4_SIDECAR", "0")
+        lon = np.array([2.0004, 4.9999, 0.01])
+        lat = np.array([48.0003, 45.0001, 49.99])
+        out = np.empty(3)
+        _native.srtm4_batch(lib, lon, lat, out, str(tmp_path),
+                            srtm4.geoid.GEOID, wrt_ellipsoid=False)
+        col, row = ((lon / srtm4.raster.RES).astype(int),
+                    ((50 - lat) / srtm4.raster.RES).astype(int))
+        np.testing.assert_allclose(out[:2], data[row[:2], col[:2]], atol=2)
+        assert out[2] == 0
+        lib.srtm4_set_cachedir(b"")